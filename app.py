@@ -1,12 +1,37 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, g, stream_with_context
 import sqlite3
+import csv
+import io
+import json
 import hashlib
 import os
 import datetime
 import functools
 import uuid
 import ipaddress
-from database import get_db_connection, init_db
+import math
+import base64
+import threading
+import time
+import zlib
+from database import (
+    DB_DIR,
+    ROLLUP_GRAINS,
+    PoolTimeout,
+    all_play_sessions,
+    begin_immediate,
+    db_pool,
+    init_db,
+    iso_to_epoch,
+    play_session_columns,
+)
+from cache import TTLCache
+from heartbeats import heartbeat_buffer
+from license_import import IMPORT_FORMATS, import_licenses, iter_records, open_text_stream
+from maintenance import maintenance
+from metrics import metrics
+from query_log import query_log
+from rate_limit import rate_limiter
 
 app = Flask(__name__)
 
@@ -19,6 +44,93 @@ def generate_admin_token(username, password):
     return hashlib.sha256(data.encode()).hexdigest()
 
 
+def get_db():
+    """Request-scoped pooled connection, returned to the pool on teardown"""
+    if "db" not in g:
+        g.db = db_pool.checkout()
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        db_pool.release(conn)
+
+
+@app.before_request
+def start_request_metrics():
+    # Labelled by route pattern, not raw path, to keep label cardinality bounded.
+    rule = request.url_rule
+    metrics.start_request(rule.rule if rule is not None else "unmatched")
+
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    metrics.finish_request(request.method, g.get("response_status", 500))
+
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(exc):
+    return jsonify({"success": False, "message": "服务繁忙，请稍后重试"}), 503
+
+
+# In-memory admin token index. Tokens are derived from username/password, so the
+# index is rebuilt whenever admin_users changes. Other worker processes notice the
+# change through the mtime of a stamp file next to the database.
+ADMIN_TOKEN_STAMP_PATH = os.path.join(DB_DIR, "admin_tokens.stamp")
+_admin_token_lock = threading.Lock()
+_admin_token_index = {}
+_admin_token_stamp = None
+
+
+def read_admin_token_stamp():
+    try:
+        return os.stat(ADMIN_TOKEN_STAMP_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_admin_token_index():
+    """Rebuild the token -> username index from admin_users"""
+    global _admin_token_index, _admin_token_stamp
+    # Read the stamp before the table so a concurrent change triggers another reload.
+    stamp = read_admin_token_stamp()
+    with db_pool.connection() as conn:
+        users = conn.execute("SELECT username, password FROM admin_users").fetchall()
+
+    index = {
+        generate_admin_token(user["username"], user["password"]): user["username"]
+        for user in users
+    }
+    with _admin_token_lock:
+        _admin_token_index = index
+        _admin_token_stamp = stamp
+
+
+def invalidate_admin_token_index():
+    """Signal every process that admin_users changed and reload locally"""
+    with _admin_token_lock:
+        previous = read_admin_token_stamp() or 0
+        stamp = max(time.time_ns(), previous + 1)
+        with open(ADMIN_TOKEN_STAMP_PATH, "a"):
+            pass
+        os.utime(ADMIN_TOKEN_STAMP_PATH, ns=(stamp, stamp))
+    load_admin_token_index()
+
+
+def lookup_admin_token(token):
+    if read_admin_token_stamp() != _admin_token_stamp:
+        load_admin_token_index()
+    return _admin_token_index.get(token)
+
+
 # Decorator to require admin token
 def require_admin_token(f):
     @functools.wraps(f)
@@ -27,28 +139,23 @@ def require_admin_token(f):
         if not token:
             return jsonify({"message": "未授权访问"}), 401
 
-        # Validate token by checking if it matches any user's token
-        conn = get_db_connection()
-        users = conn.execute("SELECT username, password FROM admin_users").fetchall()
-        conn.close()
-
-        valid = False
-        for user in users:
-            expected_token = generate_admin_token(user["username"], user["password"])
-            if token == expected_token:
-                valid = True
-                break
-
-        if not valid:
+        if not lookup_admin_token(token):
             return jsonify({"message": "未授权访问"}), 401
         return f(*args, **kwargs)
 
     return decorated_function
 
 
-# Initialize DB on startup
+# Initialize DB on startup. Under serve.py the master has already migrated the
+# database before forking, and workers skip it.
 with app.app_context():
-    init_db()
+    if os.environ.get("KEYHUB_SKIP_INIT_DB") != "1":
+        init_db()
+    load_admin_token_index()
+
+# Stale play sessions are timed out by a background thread, not by request handlers.
+if os.environ.get("KEYHUB_MAINTENANCE", "1") != "0":
+    maintenance.start()
 
 
 def generate_key():
@@ -64,7 +171,6 @@ def generate_key():
     return f"KH-{part1}-{part2}"
 
 
-PLAY_SESSION_TIMEOUT_HOURS = 8
 COUNT_BASED_AUTH_TYPES = {"count", "count_date"}
 PROJECT_TYPES = {
     "account": "账号管理",
@@ -80,7 +186,18 @@ def normalize_project_type(project_type):
     return project_type
 
 
+def parse_session_timeout(value):
+    """Per-project play session timeout in minutes; empty means the global default"""
+    if value in ("", None):
+        return None
+    minutes = int(value)
+    if minutes <= 0:
+        raise ValueError
+    return minutes
+
+
 def utc_now_iso():
+    # Local time, like every stored timestamp string; *_ts columns carry the epoch.
     return datetime.datetime.now().isoformat()
 
 
@@ -99,10 +216,11 @@ def parse_date_or_datetime(value):
 
 
 def is_license_expired(license_row):
-    expires_at = parse_date_or_datetime(license_row["valid_until"])
-    if not expires_at:
+    # valid_until_ts already applies the date-only end-of-day rule.
+    valid_until_ts = license_row["valid_until_ts"]
+    if valid_until_ts is None:
         return False
-    return datetime.datetime.now() > expires_at
+    return int(time.time()) > valid_until_ts
 
 
 def uses_play_count(license_row):
@@ -123,6 +241,59 @@ def normalize_auth_type(auth_type):
     return auth_type
 
 
+def parse_flag(value, default=True):
+    if value in ("", None):
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "y", "on")
+
+
+def validate_license_record(record, project_type):
+    """Normalize one imported license row; raises ValueError with the reason"""
+    key = str(record.get("license_key") or record.get("key") or "").strip()
+    if not key:
+        raise ValueError("密钥不能为空")
+
+    auth_type = normalize_auth_type(str(record.get("auth_type") or "unlimited").strip())
+    if not auth_type:
+        raise ValueError("授权类型无效")
+
+    remaining_plays = record.get("remaining_plays")
+    if remaining_plays in ("", None):
+        remaining_plays = 0 if auth_type in COUNT_BASED_AUTH_TYPES else None
+    else:
+        try:
+            remaining_plays = int(remaining_plays)
+        except (TypeError, ValueError):
+            raise ValueError("播放次数必须是非负整数")
+        if remaining_plays < 0:
+            raise ValueError("播放次数必须是非负整数")
+
+    valid_until = str(record.get("valid_until") or "").strip() or None
+    if valid_until and not parse_date_or_datetime(valid_until):
+        raise ValueError("到期时间格式无效")
+
+    if project_type != "playback" and (
+        auth_type != "unlimited" or remaining_plays is not None or valid_until
+    ):
+        raise ValueError("仅播控管理项目可设置次数和到期时间")
+
+    machine_code = str(record.get("machine_code") or "").strip() or None
+    if project_type == "playback" and not machine_code:
+        machine_code = key
+
+    return {
+        "license_key": key,
+        "is_active": 1 if parse_flag(record.get("is_active")) else 0,
+        "remarks": str(record.get("remarks") or ""),
+        "auth_type": auth_type,
+        "remaining_plays": remaining_plays,
+        "valid_until": valid_until,
+        "machine_code": machine_code,
+    }
+
+
 def serialize_license_status(license_row):
     expired = is_license_expired(license_row)
     count_ok = has_remaining_plays(license_row)
@@ -156,17 +327,138 @@ def serialize_license_status(license_row):
     }
 
 
+# One probe per composite index instead of a single "license_key = ? OR
+# machine_code = ?" query: without sqlite_stat1 (KeyHub never runs ANALYZE) the
+# planner answers the OR through the project_id index and walks every license
+# of the project, while each probe has exactly one matching index.
+CLIENT_LICENSE_BY_KEY_QUERY = """
+    SELECT l.*, p.name AS project_name, p.project_type AS project_type
+    FROM projects p
+    JOIN licenses l ON l.project_id = p.id
+    WHERE p.name = ? AND l.license_key = ?
+"""
+CLIENT_LICENSE_BY_MACHINE_QUERY = """
+    SELECT l.*, p.name AS project_name, p.project_type AS project_type
+    FROM projects p
+    JOIN licenses l ON l.project_id = p.id
+    WHERE p.name = ? AND p.project_type = 'playback' AND l.machine_code = ?
+    LIMIT 1
+"""
+
+
 def get_license_for_client(conn, key_value, project_name):
-    return conn.execute(
-        """
-        SELECT l.*, p.name as project_name, p.project_type as project_type
-        FROM licenses l
-        JOIN projects p ON l.project_id = p.id
-        WHERE (l.license_key = ? OR (p.project_type = 'playback' AND l.machine_code = ?))
-            AND p.name = ?
-        """,
-        (key_value, key_value, project_name),
-    ).fetchone()
+    """Resolve a client key within a project using two indexed probes.
+
+    The license is looked up by (project_id, license_key) first; playback
+    projects fall back to (project_id, machine_code).
+    """
+    params = (project_name, key_value)
+    return (
+        conn.execute(CLIENT_LICENSE_BY_KEY_QUERY, params).fetchone()
+        or conn.execute(CLIENT_LICENSE_BY_MACHINE_QUERY, params).fetchone()
+    )
+
+
+def chunked(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def get_licenses_for_clients(conn, lookups):
+    """Set-based variant of get_license_for_client for many (key, project_name) pairs.
+
+    Returns {(key, project_name): license_row} for the pairs that resolve, with
+    the same precedence as the single lookup (license_key before machine_code).
+    """
+    keys_by_project = {}
+    for key_value, project_name in lookups:
+        keys_by_project.setdefault(project_name, set()).add(key_value)
+
+    projects = {}
+    for names in chunked(keys_by_project, 500):
+        placeholders = ", ".join("?" * len(names))
+        for project in conn.execute(
+            f"SELECT id, name, project_type FROM projects WHERE name IN ({placeholders})",
+            names,
+        ):
+            projects[project["name"]] = project
+
+    found = {}
+    for project_name, keys in keys_by_project.items():
+        project = projects.get(project_name)
+        if not project:
+            continue
+
+        columns = ["license_key"]
+        if project["project_type"] == "playback":
+            columns.append("machine_code")
+        for column in columns:
+            missing = [key for key in keys if (key, project_name) not in found]
+            for chunk in chunked(missing, 500):
+                placeholders = ", ".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"""
+                    SELECT l.*, ? as project_name, ? as project_type
+                    FROM licenses l
+                    WHERE l.project_id = ? AND l.{column} IN ({placeholders})
+                    ORDER BY l.id
+                    """,
+                    (project["name"], project["project_type"], project["id"], *chunk),
+                )
+                for row in rows:
+                    found.setdefault((row[column], project_name), row)
+    return found
+
+
+# Client license rows for /api/verify and /api/license/status, keyed by
+# (project_name, key). Rows are cached rather than serialized statuses so expiry
+# is still evaluated on every request. Writes in this process invalidate entries
+# through their tags; other worker processes see changes after at most the TTL.
+license_cache = TTLCache(
+    maxsize=int(os.environ.get("KEYHUB_LICENSE_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("KEYHUB_LICENSE_CACHE_TTL", "5")),
+)
+
+metrics.add_collector(
+    "keyhub_db_pool",
+    db_pool.stats,
+    counters=("checkouts", "reused", "waits", "timeouts", "opened", "closed"),
+)
+metrics.add_collector(
+    "keyhub_license_cache",
+    license_cache.stats,
+    counters=("hits", "misses", "expired", "evictions", "invalidations"),
+    exclude=("hit_ratio", "ttl"),
+)
+metrics.add_collector(
+    "keyhub_heartbeats",
+    heartbeat_buffer.stats,
+    counters=("recorded", "flushes", "flushed_rows", "flush_errors"),
+)
+
+
+def lookup_client_license(key_value, project_name):
+    cache_key = (project_name, key_value)
+    license_row = license_cache.get(cache_key)
+    if license_row is not None:
+        return license_row
+
+    license_row = get_license_for_client(get_db(), key_value, project_name)
+    if license_row is None:
+        return None
+
+    license_row = dict(license_row)
+    license_cache.set(
+        cache_key,
+        license_row,
+        tags=(
+            ("license", license_row["id"]),
+            ("project", license_row["project_id"]),
+            ("key", license_row["license_key"]),
+        ),
+    )
+    return license_row
 
 
 def check_machine_code(license_row, machine_code):
@@ -229,6 +521,30 @@ def get_request_public_ip():
     return normalized_candidates[0] if normalized_candidates else None
 
 
+def rate_limited(f):
+    """Token-bucket limits per client IP and per (project, key), see rate_limit.py"""
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            data = {}
+        key = data.get("key") or data.get("custom_key") or data.get("machine_code")
+        retry_after = rate_limiter.check(
+            request.url_rule.rule,
+            ip=get_request_public_ip() or request.remote_addr,
+            project=data.get("project_name"),
+            key=str(key)[:256] if key else None,
+        )
+        if retry_after is not None:
+            response = jsonify({"success": False, "message": "请求过于频繁，请稍后重试"})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(retry_after)
+            return response
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
 def choose_device_ip(submitted_ip):
     request_ip = get_request_public_ip()
     if request_ip:
@@ -238,26 +554,6 @@ def choose_device_ip(submitted_ip):
     return normalized_submitted
 
 
-def mark_stale_play_sessions(conn):
-    cutoff = (
-        datetime.datetime.now()
-        - datetime.timedelta(hours=PLAY_SESSION_TIMEOUT_HOURS)
-    ).isoformat()
-    conn.execute(
-        """
-        UPDATE play_sessions
-        SET status = 'timeout',
-            ended_at = COALESCE(ended_at, last_heartbeat_at, started_at),
-            duration_seconds = CAST(
-                (julianday(COALESCE(last_heartbeat_at, started_at)) - julianday(started_at)) * 86400
-                AS INTEGER
-            )
-        WHERE status = 'playing' AND started_at < ?
-        """,
-        (cutoff,),
-    )
-
-
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -305,12 +601,11 @@ def login():
         return jsonify({"message": "用户名和密码不能为空"}), 400
 
     # Check username and password directly (plain text)
-    conn = get_db_connection()
+    conn = get_db()
     user = conn.execute(
         "SELECT * FROM admin_users WHERE username = ? AND password = ?",
         (username, password),
     ).fetchone()
-    conn.close()
 
     if user:
         # Generate token using username and plain password
@@ -324,11 +619,10 @@ def login():
 @app.route("/api/projects", methods=["GET"])
 @require_admin_token
 def get_projects():
-    conn = get_db_connection()
+    conn = get_db()
     projects = conn.execute(
         "SELECT * FROM projects ORDER BY created_at DESC"
     ).fetchall()
-    conn.close()
     return jsonify([dict(p) for p in projects])
 
 
@@ -343,22 +637,31 @@ def create_project():
         return jsonify({"message": "项目名称必填"}), 400
     if not project_type:
         return jsonify({"message": "项目类型无效"}), 400
+    try:
+        timeout_minutes = parse_session_timeout(data.get("play_session_timeout_minutes"))
+    except (TypeError, ValueError):
+        return jsonify({"message": "播放超时时间必须是正整数（分钟）"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     try:
         conn.execute(
             """
             INSERT INTO projects (
-                name, description, project_type, created_at
-            ) VALUES (?, ?, ?, ?)
+                name, description, project_type, created_at,
+                play_session_timeout_minutes
+            ) VALUES (?, ?, ?, ?, ?)
             """,
-            (name, description, project_type, datetime.datetime.now().isoformat()),
+            (
+                name,
+                description,
+                project_type,
+                datetime.datetime.now().isoformat(),
+                timeout_minutes,
+            ),
         )
         conn.commit()
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({"message": "项目名称已存在"}), 400
-    conn.close()
     return jsonify({"success": True, "message": "项目创建成功"})
 
 
@@ -373,14 +676,18 @@ def update_project(id):
         project_type = normalize_project_type(project_type)
         if not project_type:
             return jsonify({"message": "项目类型无效"}), 400
+    update_timeout = "play_session_timeout_minutes" in data
+    try:
+        timeout_minutes = parse_session_timeout(data.get("play_session_timeout_minutes"))
+    except (TypeError, ValueError):
+        return jsonify({"message": "播放超时时间必须是正整数（分钟）"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     # Check if default
     proj = conn.execute(
         "SELECT is_default FROM projects WHERE id = ?", (id,)
     ).fetchone()
     if not proj:
-        conn.close()
         return jsonify({"message": "未找到项目"}), 404
 
     # Can't change default project? Spec says "Default project cannot be deleted", doesn't explicitly say not editable, but let's allow content edit.
@@ -397,6 +704,9 @@ def update_project(id):
         if project_type is not None:
             updates.append("project_type = ?")
             params.append(project_type)
+        if update_timeout:
+            updates.append("play_session_timeout_minutes = ?")
+            params.append(timeout_minutes)
 
         if updates:
             params.append(id)
@@ -404,55 +714,320 @@ def update_project(id):
                 f'UPDATE projects SET {", ".join(updates)} WHERE id = ?', params
             )
             conn.commit()
+            license_cache.invalidate(("project", id))
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({"message": "名称冲突"}), 400
 
-    conn.close()
     return jsonify({"success": True, "message": "项目已更新"})
 
 
 @app.route("/api/projects/<int:id>", methods=["DELETE"])
 @require_admin_token
 def delete_project(id):
-    conn = get_db_connection()
+    conn = get_db()
     proj = conn.execute(
         "SELECT is_default FROM projects WHERE id = ?", (id,)
     ).fetchone()
     if not proj:
-        conn.close()
         return jsonify({"message": "未找到项目"}), 404
 
     if proj["is_default"]:
-        conn.close()
         return jsonify({"message": "无法删除默认项目"}), 403
 
+    conn.execute("DELETE FROM archive.play_sessions WHERE project_id = ?", (id,))
     conn.execute("DELETE FROM projects WHERE id = ?", (id,))
     conn.commit()
-    conn.close()
+    license_cache.invalidate(("project", id))
     return jsonify({"success": True, "message": "项目已删除"})
 
 
-# --- Licenses API (formerly Keys API) ---
-@app.route("/api/keys", methods=["GET"])
+@app.route("/api/projects/<int:id>/stats", methods=["GET"])
 @require_admin_token
-def get_keys():
-    project_id = request.args.get("project_id")
-    conn = get_db_connection()
-    query = """
-        SELECT l.*
-        FROM licenses l 
+def get_project_stats(id):
+    """Dashboard counters from project_stats plus an indexed expired count"""
+    conn = get_db()
+    stats = conn.execute(
+        "SELECT * FROM project_stats WHERE project_id = ?", (id,)
+    ).fetchone()
+    if not stats:
+        return jsonify({"message": "未找到项目"}), 404
+
+    # A range on the (project_id, valid_until_ts) index.
+    condition, params = expired_license_condition()
+    expired = conn.execute(
+        f"SELECT COUNT(*) FROM licenses l WHERE l.project_id = ? AND {condition}",
+        [id, *params],
+    ).fetchone()[0]
+
+    result = dict(stats)
+    result["expired"] = expired
+    return jsonify(result)
+
+
+# --- Licenses API (formerly Keys API) ---
+KEYS_PAGE_MAX = 1000
+LOW_PLAYS_THRESHOLD = 5
+LOW_PLAYS_THRESHOLD_MAX = 1000000
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, types=None):
+    """The two sort values of a cursor; `types` gives the expected type of each."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("cursor 无效")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("cursor 无效")
+    if types is not None:
+        for value, expected in zip(values, types):
+            # bool is an int subclass but never a valid sort value.
+            if isinstance(value, bool) or not isinstance(value, expected):
+                raise ValueError("cursor 无效")
+    return values
+
+
+def expired_license_condition(now_ts=None):
+    """SQL condition (and params) matching licenses whose valid_until has passed.
+
+    Same rule as is_license_expired: date-only values (YYYY-MM-DD) stay valid
+    until the end of that day.
     """
+    if now_ts is None:
+        now_ts = int(time.time())
+    return "l.valid_until_ts < ?", [now_ts]
+
+
+def low_plays_condition(threshold):
+    """SQL condition (and params) matching count-based licenses with fewer than
+    `threshold` plays left.
+
+    Shared by GET /api/keys?low_plays= and /api/licenses/low-plays. Licenses
+    without a play count (NULL remaining_plays) are not low. The auth_type term
+    must match the idx_licenses_low_plays predicate verbatim.
+    """
+    threshold = max(0, min(threshold, LOW_PLAYS_THRESHOLD_MAX))
+    return "l.auth_type IN ('count', 'count_date') AND l.remaining_plays < ?", [threshold]
+
+
+def build_license_filters(args):
+    """WHERE clauses for license listings from query args; raises ValueError"""
+    clauses = []
     params = []
+
+    project_id = args.get("project_id")
     if project_id:
-        query += " WHERE l.project_id = ?"
+        clauses.append("l.project_id = ?")
         params.append(project_id)
 
-    query += " ORDER BY l.created_at DESC"
+    active = args.get("active")
+    if active not in (None, ""):
+        clauses.append("l.is_active = ?")
+        params.append(1 if parse_flag(active) else 0)
+
+    auth_type = args.get("auth_type")
+    if auth_type:
+        if not normalize_auth_type(auth_type):
+            raise ValueError("授权类型无效")
+        clauses.append("COALESCE(l.auth_type, 'unlimited') = ?")
+        params.append(auth_type)
+
+    expired = args.get("expired")
+    if expired not in (None, ""):
+        condition, condition_params = expired_license_condition()
+        if not parse_flag(expired):
+            condition = f"(l.valid_until_ts IS NULL OR NOT ({condition}))"
+        clauses.append(condition)
+        params.extend(condition_params)
+
+    low_plays = args.get("low_plays")
+    if low_plays not in (None, ""):
+        try:
+            threshold = int(low_plays)
+        except ValueError:
+            raise ValueError("low_plays 必须是整数")
+        condition, condition_params = low_plays_condition(threshold)
+        clauses.append(condition)
+        params.extend(condition_params)
+
+    prefix = args.get("q")
+    if prefix:
+        # Key prefix as an index-friendly range; remarks prefix through LIKE.
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        clauses.append(
+            "((l.license_key >= ? AND l.license_key < ?) OR l.remarks LIKE ? ESCAPE '\\')"
+        )
+        params.extend([prefix, prefix + "\U0010ffff", escaped + "%"])
+
+    return clauses, params
+
+
+@app.route("/api/keys", methods=["GET"])
+@require_admin_token
+def get_keys():
+    """List licenses, newest first.
+
+    Filters: project_id, active, auth_type, expired, low_plays, q (key/remarks
+    prefix). With limit or cursor the result is a page
+    {"items", "next_cursor"[, "total" when include_total=1]} using keyset
+    pagination on (created_at, id); without them the full list is returned.
+    """
+    try:
+        clauses, params = build_license_filters(request.args)
+    except ValueError as exc:
+        return jsonify({"message": str(exc)}), 400
+
+    paged = "limit" in request.args or "cursor" in request.args
+    conn = get_db()
+    if not paged:
+        query = "SELECT l.* FROM licenses l"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY l.created_at DESC, l.id DESC"
+        licenses = conn.execute(query, params).fetchall()
+        return jsonify([dict(l) for l in licenses])
 
-    licenses = conn.execute(query, params).fetchall()
-    conn.close()
-    return jsonify([dict(l) for l in licenses])
+    try:
+        limit = max(1, min(int(request.args.get("limit", 100)), KEYS_PAGE_MAX))
+    except ValueError:
+        return jsonify({"message": "limit 必须是整数"}), 400
+
+    page_clauses = list(clauses)
+    page_params = list(params)
+    if request.args.get("cursor"):
+        try:
+            created_at, license_id = decode_cursor(request.args["cursor"], (str, int))
+        except ValueError as exc:
+            return jsonify({"message": str(exc)}), 400
+        page_clauses.append("(l.created_at, l.id) < (?, ?)")
+        page_params.extend([created_at, license_id])
+
+    query = "SELECT l.* FROM licenses l"
+    if page_clauses:
+        query += " WHERE " + " AND ".join(page_clauses)
+    query += " ORDER BY l.created_at DESC, l.id DESC LIMIT ?"
+    licenses = conn.execute(query, page_params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(licenses) > limit:
+        licenses = licenses[:limit]
+        last = licenses[-1]
+        next_cursor = encode_cursor([last["created_at"], last["id"]])
+
+    result = {"items": [dict(l) for l in licenses], "next_cursor": next_cursor}
+    if parse_flag(request.args.get("include_total"), default=False):
+        count_query = "SELECT COUNT(*) FROM licenses l"
+        if clauses:
+            count_query += " WHERE " + " AND ".join(clauses)
+        result["total"] = conn.execute(count_query, params).fetchone()[0]
+    return jsonify(result)
+
+
+EXPIRING_DAYS = 7
+EXPIRING_DAYS_MAX = 3650
+
+
+def license_watch_page(conn, clauses, params, sort_column, args):
+    """One page of licenses ordered by (sort_column, id), for the ops watch lists.
+
+    Common filters: project_id, project_type, include_disabled; paging with
+    limit and an opaque cursor.
+    """
+    if args.get("project_id"):
+        clauses.append("l.project_id = ?")
+        params.append(args["project_id"])
+    if args.get("project_type"):
+        project_type = normalize_project_type(args["project_type"])
+        if not project_type:
+            raise ValueError("项目类型无效")
+        clauses.append("p.project_type = ?")
+        params.append(project_type)
+    if not parse_flag(args.get("include_disabled"), default=False):
+        clauses.append("l.is_active = 1")
+
+    try:
+        limit = max(1, min(int(args.get("limit", 100)), KEYS_PAGE_MAX))
+    except ValueError:
+        raise ValueError("limit 必须是整数")
+    if args.get("cursor"):
+        clauses.append(f"({sort_column}, l.id) > (?, ?)")
+        # Both watch lists sort by an integer column (valid_until_ts, remaining_plays).
+        params.extend(decode_cursor(args["cursor"], (int, int)))
+
+    rows = conn.execute(
+        f"""
+        SELECT l.*, p.name AS project_name, p.project_type AS project_type
+        FROM licenses l
+        JOIN projects p ON p.id = l.project_id
+        WHERE {" AND ".join(clauses)}
+        ORDER BY {sort_column}, l.id
+        LIMIT ?
+        """,
+        params + [limit + 1],
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([last[sort_column.split(".")[-1]], last["id"]])
+    return {"items": [dict(row) for row in rows], "next_cursor": next_cursor}
+
+
+@app.route("/api/licenses/expiring", methods=["GET"])
+@require_admin_token
+def get_expiring_licenses():
+    """Licenses whose valid_until falls within the next `days` days, soonest first"""
+    try:
+        days = float(request.args.get("days", EXPIRING_DAYS))
+    except ValueError:
+        return jsonify({"message": "days 必须是数字"}), 400
+    if not math.isfinite(days):
+        return jsonify({"message": "days 必须是数字"}), 400
+    if days <= 0:
+        return jsonify({"message": "days 必须大于 0"}), 400
+    days = min(days, EXPIRING_DAYS_MAX)
+    try:
+        now_ts = int(time.time())
+        # Served by the partial (valid_until_ts, id) index, or the
+        # (project_id, valid_until_ts) index when a project is given.
+        result = license_watch_page(
+            get_db(),
+            ["l.valid_until_ts >= ?", "l.valid_until_ts < ?"],
+            [now_ts, now_ts + int(days * 86400)],
+            "l.valid_until_ts",
+            request.args,
+        )
+    except ValueError as exc:
+        return jsonify({"message": str(exc)}), 400
+    return jsonify(result)
+
+
+@app.route("/api/licenses/low-plays", methods=["GET"])
+@require_admin_token
+def get_low_plays_licenses():
+    """Count-based licenses with fewer than `threshold` plays left, fewest first"""
+    try:
+        threshold = int(request.args.get("threshold", LOW_PLAYS_THRESHOLD))
+    except ValueError:
+        return jsonify({"message": "threshold 必须是整数"}), 400
+    condition, condition_params = low_plays_condition(threshold)
+    try:
+        result = license_watch_page(
+            get_db(),
+            [condition],
+            condition_params,
+            "l.remaining_plays",
+            request.args,
+        )
+    except ValueError as exc:
+        return jsonify({"message": str(exc)}), 400
+    return jsonify(result)
 
 
 @app.route("/api/keys", methods=["POST"])
@@ -466,17 +1041,15 @@ def create_key():
     if not project_id:
         return jsonify({"message": "项目 ID 必填"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     project = conn.execute(
-        "SELECT project_type FROM projects WHERE id = ?", (project_id,)
+        "SELECT id, project_type FROM projects WHERE id = ?", (project_id,)
     ).fetchone()
     if not project:
-        conn.close()
         return jsonify({"message": "项目不存在"}), 404
 
     project_type = project["project_type"] or "activation"
     if project_type == "playback" and not custom_key:
-        conn.close()
         return jsonify({"message": "播控项目需填写客户端机器码"}), 400
 
     if custom_key:
@@ -503,22 +1076,373 @@ def create_key():
                 ),
             )
             conn.commit()
+            license_cache.invalidate(("project", project["id"]))
             break
         except sqlite3.IntegrityError:
             if custom_key:
-                conn.close()
                 return jsonify({"message": "该密钥在此项目中已存在"}), 400
             new_key = generate_key()
     else:
-        conn.close()
         return jsonify({"message": "生成唯一密钥失败"}), 500
 
-    conn.close()
     return jsonify({"success": True, "key": new_key, "message": "授权创建成功"})
 
 
+# --- Streaming helpers (CSV / NDJSON) ---
+STREAM_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def encode_records(records, columns, fmt):
+    """Yield dict records as CSV lines (with header) or NDJSON lines"""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for record in records:
+            writer.writerow([record.get(column) for column in columns])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def buffer_chunks(chunks, size=STREAM_CHUNK_SIZE):
+    """Join small text pieces into ~size byte blocks to keep write calls cheap"""
+    parts = []
+    length = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        parts.append(data)
+        length += len(data)
+        if length >= size:
+            yield b"".join(parts)
+            parts = []
+            length = 0
+    if parts:
+        yield b"".join(parts)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def streaming_response(chunks, fmt, filename, compress=False):
+    chunks = buffer_chunks(chunks)
+    mimetype = STREAM_FORMATS[fmt]
+    filename = f"{filename}.{fmt}"
+    if compress:
+        chunks = gzip_chunks(chunks)
+        mimetype = "application/gzip"
+        filename += ".gz"
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+def stream_query(query, params, fmt):
+    """Encode a query result row by row without materializing it.
+
+    Rows are read while the body is sent, after get_db()'s connection has gone
+    back to the pool, so the cursor gets a connection of its own until the
+    stream finishes or is closed.
+    """
+    with db_pool.connection() as conn:
+        cursor = conn.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        yield from encode_records((dict(row) for row in cursor), columns, fmt)
+
+
+BULK_KEYS_MAX = int(os.environ.get("KEYHUB_BULK_KEYS_MAX", "100000"))
+BULK_KEYS_CHUNK_SIZE = int(os.environ.get("KEYHUB_BULK_KEYS_CHUNK_SIZE", "1000"))
+
+
+def existing_license_keys(conn, project_id, keys):
+    placeholders = ", ".join("?" * len(keys))
+    return {
+        row["license_key"]
+        for row in conn.execute(
+            f"SELECT license_key FROM licenses WHERE project_id = ? AND license_key IN ({placeholders})",
+            (project_id, *keys),
+        )
+    }
+
+
+def insert_license_chunk(conn, project, keys, remarks):
+    machine_code = project["project_type"] == "playback"
+    now = datetime.datetime.now()
+    created_at, created_at_ts = now.isoformat(), int(now.timestamp())
+    conn.executemany(
+        """INSERT INTO licenses (
+            project_id, license_key,
+            is_active, remarks, created_at, created_at_ts, machine_code
+        ) VALUES (?, ?, 1, ?, ?, ?, ?)""",
+        [
+            (project["id"], key, remarks, created_at, created_at_ts, key if machine_code else None)
+            for key in keys
+        ],
+    )
+
+
+# The bulk generators run while the response body is sent, after the view has
+# returned and get_db()'s connection has gone back to the pool, so each checks
+# out a connection of its own for the whole stream.
+def bulk_create_custom_keys(project, keys, remarks):
+    """Insert the given keys chunk by chunk; keys already present are reported as such."""
+    with db_pool.connection() as conn:
+        for chunk in chunked(keys, BULK_KEYS_CHUNK_SIZE):
+            begin_immediate(conn)
+            try:
+                existing = existing_license_keys(conn, project["id"], chunk)
+                insert_license_chunk(
+                    conn, project, [key for key in chunk if key not in existing], remarks
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            license_cache.invalidate(("project", project["id"]))
+            for key in chunk:
+                yield {"key": key, "status": "exists" if key in existing else "created"}
+
+
+def bulk_generate_keys(project, count, remarks):
+    """Generate count new keys; collisions are regenerated per chunk, not per row."""
+    remaining = count
+    with db_pool.connection() as conn:
+        while remaining:
+            size = min(remaining, BULK_KEYS_CHUNK_SIZE)
+            begin_immediate(conn)
+            try:
+                keys = set()
+                for attempt in range(5):
+                    while len(keys) < size:
+                        keys.add(generate_key())
+                    keys -= existing_license_keys(conn, project["id"], list(keys))
+                    if len(keys) == size:
+                        break
+                else:
+                    raise RuntimeError("生成唯一密钥失败")
+                insert_license_chunk(conn, project, sorted(keys), remarks)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            license_cache.invalidate(("project", project["id"]))
+            remaining -= size
+            for key in sorted(keys):
+                yield {"key": key, "status": "created"}
+
+
+@app.route("/api/keys/bulk", methods=["POST"])
+@require_admin_token
+def create_keys_bulk():
+    """Create many licenses at once and stream them back as CSV or NDJSON.
+
+    Body: project_id, remarks, format (csv|ndjson) and either count (generated
+    keys) or keys (custom keys; machine codes for playback projects).
+    """
+    data = request.json or {}
+    project_id = data.get("project_id")
+    remarks = data.get("remarks", "")
+    fmt = data.get("format") or request.args.get("format") or "csv"
+    keys = data.get("keys")
+    count = data.get("count")
+
+    if not project_id:
+        return jsonify({"message": "项目 ID 必填"}), 400
+    if fmt not in STREAM_FORMATS:
+        return jsonify({"message": "导出格式无效"}), 400
+
+    conn = get_db()
+    project = conn.execute(
+        "SELECT id, project_type FROM projects WHERE id = ?", (project_id,)
+    ).fetchone()
+    if not project:
+        return jsonify({"message": "项目不存在"}), 404
+
+    if keys is not None:
+        if not isinstance(keys, list):
+            return jsonify({"message": "keys 必须是数组"}), 400
+        if not all(isinstance(key, str) and key.strip() for key in keys):
+            return jsonify({"message": "keys 中的每一项都必须是非空字符串"}), 400
+        # Deduplicate while keeping the submitted order.
+        keys = list(dict.fromkeys(key.strip() for key in keys))
+        if not keys:
+            return jsonify({"message": "keys 不能为空"}), 400
+        if len(keys) > BULK_KEYS_MAX:
+            return jsonify({"message": f"单次最多创建 {BULK_KEYS_MAX} 条授权"}), 400
+        records = bulk_create_custom_keys(project, keys, remarks)
+    else:
+        if project["project_type"] == "playback":
+            return jsonify({"message": "播控项目需填写客户端机器码"}), 400
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            return jsonify({"message": "count 必须是正整数"}), 400
+        if count <= 0 or count > BULK_KEYS_MAX:
+            return jsonify({"message": f"count 必须在 1 到 {BULK_KEYS_MAX} 之间"}), 400
+        records = bulk_generate_keys(project, count, remarks)
+
+    return streaming_response(
+        encode_records(records, ["key", "status"], fmt),
+        fmt,
+        f"keys-{project['id']}",
+    )
+
+
+@app.route("/api/keys/import", methods=["POST"])
+@require_admin_token
+def import_keys():
+    """Stream a CSV/JSONL file of licenses into a project (upsert by key).
+
+    The file is sent as the raw request body or as the multipart field "file".
+    Query: project_id, format (csv|jsonl), dry_run, batch_size.
+    """
+    project_id = request.args.get("project_id")
+    dry_run = parse_flag(request.args.get("dry_run"), default=False)
+    upload = request.files.get("file") if request.mimetype == "multipart/form-data" else None
+    filename = upload.filename if upload else ""
+    fmt = request.args.get("format") or (
+        "jsonl" if filename.endswith((".jsonl", ".ndjson")) else "csv"
+    )
+    try:
+        batch_size = max(1, int(request.args.get("batch_size", 1000)))
+    except ValueError:
+        return jsonify({"message": "batch_size 必须是正整数"}), 400
+
+    if not project_id:
+        return jsonify({"message": "项目 ID 必填"}), 400
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({"message": "导入格式无效"}), 400
+
+    conn = get_db()
+    project = conn.execute(
+        "SELECT id, project_type FROM projects WHERE id = ?", (project_id,)
+    ).fetchone()
+    if not project:
+        return jsonify({"message": "项目不存在"}), 404
+
+    stream = open_text_stream(upload.stream if upload else request.stream)
+    try:
+        report = import_licenses(
+            conn,
+            project,
+            iter_records(stream, fmt),
+            validate_license_record,
+            datetime.datetime.now().isoformat(),
+            dry_run=dry_run,
+            batch_size=batch_size,
+        )
+    finally:
+        license_cache.invalidate(("project", project["id"]))
+    return jsonify({"success": True, **report})
+
+
+# --- Export API ---
+def parse_export_options():
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in STREAM_FORMATS:
+        raise ValueError("导出格式无效")
+    return fmt, parse_flag(request.args.get("gzip"), default=False)
+
+
+@app.route("/api/projects/<int:project_id>/licenses/export", methods=["GET"])
+@require_admin_token
+def export_project_licenses(project_id):
+    """Stream a project's licenses as NDJSON or CSV (optionally gzip)
+
+    Accepts the same filters as GET /api/keys.
+    """
+    try:
+        fmt, compress = parse_export_options()
+        args = request.args.to_dict()
+        args["project_id"] = project_id
+        clauses, params = build_license_filters(args)
+    except ValueError as exc:
+        return jsonify({"message": str(exc)}), 400
+
+    conn = get_db()
+    if not conn.execute("SELECT 1 FROM projects WHERE id = ?", (project_id,)).fetchone():
+        return jsonify({"message": "未找到项目"}), 404
+
+    query = (
+        "SELECT l.* FROM licenses l WHERE "
+        + " AND ".join(clauses)
+        + " ORDER BY l.created_at, l.id"
+    )
+    return streaming_response(
+        stream_query(query, params, fmt),
+        fmt,
+        f"licenses-{project_id}",
+        compress=compress,
+    )
+
+
+@app.route("/api/play-sessions/export", methods=["GET"])
+@require_admin_token
+def export_play_sessions():
+    """Stream play sessions started in [start, end] as NDJSON or CSV (optionally gzip)
+
+    Query: start, end (ISO date or datetime; a date-only end covers the whole
+    day), project_id, license_id, format, gzip.
+    """
+    try:
+        fmt, compress = parse_export_options()
+    except ValueError as exc:
+        return jsonify({"message": str(exc)}), 400
+
+    clauses = []
+    params = []
+    start = request.args.get("start")
+    end = request.args.get("end")
+    try:
+        if start:
+            clauses.append("started_at >= ?")
+            params.append(datetime.datetime.fromisoformat(start).isoformat())
+        if end:
+            end_at = parse_date_or_datetime(end)
+            if not end_at:
+                raise ValueError
+            clauses.append("started_at <= ?")
+            params.append(end_at.isoformat())
+    except ValueError:
+        return jsonify({"message": "时间格式无效"}), 400
+
+    for column in ("project_id", "license_id"):
+        if request.args.get(column):
+            clauses.append(f"{column} = ?")
+            params.append(request.args[column])
+
+    conn = get_db()
+    where = "WHERE " + " AND ".join(clauses) if clauses else ""
+    # Both sides are read in index order and merged, so the export still streams.
+    query = all_play_sessions(conn, where) + " ORDER BY started_at, id"
+    return streaming_response(
+        stream_query(query, params + params, fmt),
+        fmt,
+        "play-sessions",
+        compress=compress,
+    )
+
+
 # --- Public Registration API (No Auth Required) ---
 @app.route("/api/register", methods=["POST"])
+@rate_limited
 def register_user():
     """Public endpoint for client-side user registration"""
     data = request.json or {}
@@ -532,14 +1456,13 @@ def register_user():
     if not project_name:
         return jsonify({"success": False, "message": "项目名称必填"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
 
     # Require explicit project name to locate the target project
     project = conn.execute(
         "SELECT id FROM projects WHERE name = ?", (project_name,)
     ).fetchone()
     if not project:
-        conn.close()
         return jsonify({"success": False, "message": "指定的项目不存在"}), 404
 
     project_id = project["id"]
@@ -561,7 +1484,7 @@ def register_user():
             ),
         )
         conn.commit()
-        conn.close()
+        license_cache.invalidate(("project", project_id))
         return jsonify({"success": True, "key": custom_key, "message": "注册成功"}), 201
     except sqlite3.IntegrityError:
         # Key already exists - update last_registered_at timestamp
@@ -573,29 +1496,34 @@ def register_user():
                 (now2, custom_key, project_id),
             )
             conn.commit()
-            conn.close()
             return jsonify({"success": True, "key": custom_key, "message": "重新注册成功"}), 200
         except Exception as upd_exc:
-            conn.close()
             return jsonify({"success": False, "message": f"更新注册时间失败: {str(upd_exc)}"}), 500
     except Exception as exc:
-        conn.close()
         return jsonify({"success": False, "message": f"注册失败: {str(exc)}"}), 500
 
 
 @app.route("/api/keys/<key_value>", methods=["DELETE"])
 @require_admin_token
 def delete_key(key_value):
-    conn = get_db_connection()
+    conn = get_db()
     # Find the license by license_key (need to check project_id from query or handle all)
     # For simplicity, delete by license_key (assuming it's unique enough, or we need project_id)
     project_id = request.args.get("project_id")
+    condition = "license_key = ?"
+    params = [key_value]
     if project_id:
-        conn.execute("DELETE FROM licenses WHERE license_key = ? AND project_id = ?", (key_value, project_id))
-    else:
-        conn.execute("DELETE FROM licenses WHERE license_key = ?", (key_value,))
+        condition += " AND project_id = ?"
+        params.append(project_id)
+    # Archived sessions are outside the foreign key cascade.
+    conn.execute(
+        f"DELETE FROM archive.play_sessions WHERE license_id IN "
+        f"(SELECT id FROM licenses WHERE {condition})",
+        params,
+    )
+    conn.execute(f"DELETE FROM licenses WHERE {condition}", params)
     conn.commit()
-    conn.close()
+    license_cache.invalidate(("key", key_value))
     return jsonify({"success": True, "message": "授权已删除"})
 
 
@@ -607,7 +1535,7 @@ def toggle_key_status(key_value):
     if is_active is None:
         return jsonify({"message": "缺少状态参数"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     project_id = request.args.get("project_id")
     if project_id:
         conn.execute(
@@ -620,7 +1548,7 @@ def toggle_key_status(key_value):
             (1 if is_active else 0, key_value),
         )
     conn.commit()
-    conn.close()
+    license_cache.invalidate(("key", key_value))
     return jsonify({"success": True, "message": "状态已更新"})
 
 
@@ -630,7 +1558,7 @@ def update_key_remarks(key_value):
     data = request.json
     remarks = data.get("remarks", "")
 
-    conn = get_db_connection()
+    conn = get_db()
     project_id = request.args.get("project_id")
     if project_id:
         conn.execute("UPDATE licenses SET remarks = ? WHERE license_key = ? AND project_id = ?", 
@@ -638,7 +1566,7 @@ def update_key_remarks(key_value):
     else:
         conn.execute("UPDATE licenses SET remarks = ? WHERE license_key = ?", (remarks, key_value))
     conn.commit()
-    conn.close()
+    license_cache.invalidate(("key", key_value))
     return jsonify({"success": True, "message": "备注已更新"})
 
 
@@ -658,7 +1586,7 @@ def update_license_entitlement(license_id):
     if valid_until and not parse_date_or_datetime(valid_until):
         return jsonify({"message": "到期时间格式无效"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     license_row = conn.execute(
         """
         SELECT l.*, p.name as project_name, p.project_type as project_type
@@ -669,10 +1597,8 @@ def update_license_entitlement(license_id):
         (license_id,),
     ).fetchone()
     if not license_row:
-        conn.close()
         return jsonify({"message": "未找到授权"}), 404
     if license_row["project_type"] != "playback":
-        conn.close()
         return jsonify({"message": "仅播控管理项目可设置次数和到期时间"}), 400
 
     try:
@@ -691,7 +1617,6 @@ def update_license_entitlement(license_id):
                 raise ValueError
             next_remaining_plays = (next_remaining_plays or 0) + add_plays
     except (TypeError, ValueError):
-        conn.close()
         return jsonify({"message": "播放次数必须是非负整数"}), 400
 
     conn.execute(
@@ -705,6 +1630,7 @@ def update_license_entitlement(license_id):
         (auth_type, next_remaining_plays, valid_until, license_id),
     )
     conn.commit()
+    license_cache.invalidate(("license", license_id))
 
     row = conn.execute(
         """
@@ -716,39 +1642,120 @@ def update_license_entitlement(license_id):
         (license_id,),
     ).fetchone()
     result = serialize_license_status(row)
-    conn.close()
     return jsonify({"success": True, "message": "授权权益已更新", "license": result})
 
 
 @app.route("/api/licenses/<int:license_id>/play-sessions", methods=["GET"])
 @require_admin_token
 def get_license_play_sessions(license_id):
+    """Newest sessions of a license across hot and archived storage.
+
+    Without cursor the newest `limit` sessions are returned as a list; with
+    cursor (or page=1) the result is {"items", "next_cursor"} using keyset
+    pagination on (started_at, id). Read-only: heartbeats still buffered in
+    this process are overlaid, those of other workers can be up to one flush
+    interval old.
+    """
     limit = request.args.get("limit", 100)
     try:
         limit = max(1, min(int(limit), 500))
     except ValueError:
         limit = 100
 
-    conn = get_db_connection()
-    mark_stale_play_sessions(conn)
-    conn.commit()
-
+    page_clause = ""
+    params = [license_id]
+    if request.args.get("cursor"):
+        try:
+            started_at, session_pk = decode_cursor(request.args["cursor"], (str, int))
+        except ValueError as exc:
+            return jsonify({"message": str(exc)}), 400
+        page_clause = "AND (started_at, id) < (?, ?)"
+        params.extend([started_at, session_pk])
+    params.append(limit + 1)
+
+    conn = get_db()
+    columns = ", ".join(play_session_columns(conn))
+    # Each side walks its (license_id, started_at, id) index for at most one page.
+    side = f"""
+        SELECT {columns} FROM {{table}}
+        WHERE license_id = ? {page_clause}
+        ORDER BY started_at DESC, id DESC
+        LIMIT ?
+    """
     sessions = conn.execute(
-        """
-        SELECT *
-        FROM play_sessions
-        WHERE license_id = ?
-        ORDER BY started_at DESC
+        f"""
+        SELECT * FROM ({side.format(table="main.play_sessions")})
+        UNION
+        SELECT * FROM ({side.format(table="archive.play_sessions")})
+        ORDER BY started_at DESC, id DESC
         LIMIT ?
         """,
-        (license_id, limit),
+        params + params + [limit + 1],
     ).fetchall()
-    conn.close()
-    return jsonify([dict(session) for session in sessions])
+
+    next_cursor = None
+    if len(sessions) > limit:
+        sessions = sessions[:limit]
+        last = sessions[-1]
+        next_cursor = encode_cursor([last["started_at"], last["id"]])
+
+    items = [dict(session) for session in sessions]
+    for item in items:
+        pending = item["status"] == "playing" and heartbeat_buffer.pending_heartbeat(item["session_id"])
+        if pending:
+            item["last_heartbeat_at"] = pending
+            item["last_heartbeat_at_ts"] = iso_to_epoch(pending)
+    if "cursor" in request.args or parse_flag(request.args.get("page"), default=False):
+        return jsonify({"items": items, "next_cursor": next_cursor})
+    return jsonify(items)
+
+
+USAGE_TABLES = {
+    "license": ("license_usage_rollups", "license_id"),
+    "project": ("project_usage_rollups", "project_id"),
+}
+
+
+def query_usage(owner, owner_id, args):
+    """Rollup rows for one license or project; start/end are inclusive buckets"""
+    grain = args.get("grain", "day")
+    if grain not in ROLLUP_GRAINS:
+        return jsonify({"message": "grain 必须为 hour、day 或 month"}), 400
+
+    table, column = USAGE_TABLES[owner]
+    query = f"""
+        SELECT bucket, sessions, timeouts, duration_seconds
+        FROM {table}
+        WHERE grain = ? AND {column} = ?
+    """
+    params = [grain, owner_id]
+    if args.get("start"):
+        query += " AND bucket >= ?"
+        params.append(args["start"])
+    if args.get("end"):
+        query += " AND bucket <= ?"
+        params.append(args["end"])
+    query += " ORDER BY bucket"
+
+    rows = get_db().execute(query, params).fetchall()
+    return jsonify({"grain": grain, "items": [dict(row) for row in rows]})
+
+
+@app.route("/api/licenses/<int:license_id>/usage", methods=["GET"])
+@require_admin_token
+def get_license_usage(license_id):
+    return query_usage("license", license_id, request.args)
+
+
+@app.route("/api/projects/<int:id>/usage", methods=["GET"])
+@require_admin_token
+def get_project_usage(id):
+    return query_usage("project", id, request.args)
 
 
 # --- Verification API ---
 @app.route("/api/verify", methods=["POST"])
+@rate_limited
 def verify_key():
     data = request.json or {}
     key_value = data.get("key")
@@ -761,33 +1768,90 @@ def verify_key():
     if not project_name:
         return jsonify({"valid": False, "message": "项目名称不能为空"}), 400
 
-    conn = get_db_connection()
+    license_row = lookup_client_license(key_value, project_name)
+    payload, status_code = build_verify_result(license_row, machine_code)
+    return jsonify(payload), status_code
 
-    license_row = get_license_for_client(conn, key_value, project_name)
 
+def build_verify_result(license_row, machine_code):
+    """Response body and status code of /api/verify for a resolved license"""
     if not license_row:
-        conn.close()
-        return jsonify({"valid": False, "message": "未找到该密钥在此项目下的授权"}), 404
+        return {"valid": False, "message": "未找到该密钥在此项目下的授权"}, 404
 
     if not check_machine_code(license_row, machine_code):
-        conn.close()
-        return jsonify({"valid": False, "message": "机器码不匹配"}), 403
+        return {"valid": False, "message": "机器码不匹配"}, 403
 
     status = serialize_license_status(license_row)
     if not status["playable"]:
-        conn.close()
-        return jsonify({"valid": False, "message": status["message"], **status}), 403
+        return {"valid": False, "message": status["message"], **status}, 403
 
-    conn.close()
-    return jsonify({
-        "valid": True,
-        "message": "验证通过",
-        **status
-    })
+    return {"valid": True, "message": "验证通过", **status}, 200
+
+
+VERIFY_BATCH_MAX = int(os.environ.get("KEYHUB_VERIFY_BATCH_MAX", "200"))
+
+
+def verify_batch_item_error(item):
+    """Message of the 400 a malformed batch item gets, or None if it can be looked up"""
+    key_value = item.get("key")
+    project_name = item.get("project_name")
+    machine_code = item.get("machine_code")
+    if not key_value:
+        return "密钥不能为空"
+    if not project_name:
+        return "项目名称不能为空"
+    # Values become dict keys and query parameters, so only strings are accepted.
+    if not isinstance(key_value, str):
+        return "密钥必须是字符串"
+    if not isinstance(project_name, str):
+        return "项目名称必须是字符串"
+    if machine_code is not None and not isinstance(machine_code, str):
+        return "机器码必须是字符串"
+    return None
+
+
+@app.route("/api/verify/batch", methods=["POST"])
+@rate_limited
+def verify_keys_batch():
+    """Verify many (key, project_name, machine_code) items in one request.
+
+    Each result carries the body /api/verify would return plus its status code.
+    """
+    data = request.json or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "message": "items 必须是非空数组"}), 400
+    if len(items) > VERIFY_BATCH_MAX:
+        return jsonify({
+            "success": False,
+            "message": f"单次最多验证 {VERIFY_BATCH_MAX} 条",
+        }), 400
+
+    items = [item if isinstance(item, dict) else {} for item in items]
+    errors = [verify_batch_item_error(item) for item in items]
+    lookups = [
+        (item["key"], item["project_name"])
+        for item, error in zip(items, errors)
+        if error is None
+    ]
+    found = get_licenses_for_clients(get_db(), lookups) if lookups else {}
+
+    results = []
+    for item, error in zip(items, errors):
+        if error is not None:
+            payload, status_code = {"valid": False, "message": error}, 400
+        else:
+            payload, status_code = build_verify_result(
+                found.get((item["key"], item["project_name"])), item.get("machine_code")
+            )
+        results.append({"status": status_code, **payload})
+
+    return jsonify({"success": True, "results": results})
 
 
 # --- Public Playback API ---
 @app.route("/api/license/status", methods=["POST"])
+@rate_limited
 def license_status():
     data = request.json or {}
     key_value = data.get("key") or data.get("machine_code")
@@ -799,26 +1863,22 @@ def license_status():
     if not project_name:
         return jsonify({"valid": False, "message": "项目名称不能为空"}), 400
 
-    conn = get_db_connection()
-    license_row = get_license_for_client(conn, key_value, project_name)
+    license_row = lookup_client_license(key_value, project_name)
     if not license_row:
-        conn.close()
         return jsonify({"valid": False, "message": "未找到该密钥在此项目下的授权"}), 404
 
     if not check_machine_code(license_row, machine_code):
-        conn.close()
         return jsonify({"valid": False, "message": "机器码不匹配"}), 403
 
     if license_row["project_type"] != "playback":
-        conn.close()
         return jsonify({"valid": False, "message": "该项目不是播控管理类型"}), 400
 
     status = serialize_license_status(license_row)
-    conn.close()
     return jsonify({"valid": status["playable"], **status})
 
 
 @app.route("/api/play/start", methods=["POST"])
+@rate_limited
 def start_play():
     data = request.json or {}
     key_value = data.get("key") or data.get("machine_code")
@@ -835,33 +1895,29 @@ def start_play():
     if not machine_code:
         return jsonify({"success": False, "message": "机器码不能为空"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     try:
-        conn.execute("BEGIN IMMEDIATE")
-        mark_stale_play_sessions(conn)
+        begin_immediate(conn)
         license_row = get_license_for_client(conn, key_value, project_name)
         if not license_row:
             conn.rollback()
-            conn.close()
             return jsonify({"success": False, "message": "未找到该密钥在此项目下的授权"}), 404
 
         if not check_machine_code(license_row, machine_code):
             conn.rollback()
-            conn.close()
             return jsonify({"success": False, "message": "机器码不匹配"}), 403
 
         if license_row["project_type"] != "playback":
             conn.rollback()
-            conn.close()
             return jsonify({"success": False, "message": "该项目不是播控管理类型"}), 400
 
         status = serialize_license_status(license_row)
         if not status["playable"]:
             conn.rollback()
-            conn.close()
             return jsonify({"success": False, "message": status["message"], **status}), 403
 
         now = utc_now_iso()
+        now_ts = iso_to_epoch(now)
         if uses_play_count(license_row):
             cursor = conn.execute(
                 """
@@ -874,7 +1930,6 @@ def start_play():
             )
             if cursor.rowcount == 0:
                 conn.rollback()
-                conn.close()
                 return jsonify({"success": False, "message": "剩余播放次数不足"}), 403
         else:
             conn.execute(
@@ -887,8 +1942,9 @@ def start_play():
             """
             INSERT INTO play_sessions (
                 license_id, project_id, session_id, machine_code, device_ip,
-                started_at, last_heartbeat_at, status, client_version, remarks
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, 'playing', ?, ?)
+                started_at, started_at_ts, last_heartbeat_at, last_heartbeat_at_ts,
+                status, client_version, remarks
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'playing', ?, ?)
             """,
             (
                 license_row["id"],
@@ -897,12 +1953,16 @@ def start_play():
                 machine_code,
                 device_ip,
                 now,
+                now_ts,
                 now,
+                now_ts,
                 client_version,
                 remarks,
             ),
         )
         conn.commit()
+        heartbeat_buffer.mark_playing(session_id)
+        license_cache.invalidate(("license", license_row["id"]))
 
         updated = conn.execute(
             """
@@ -914,7 +1974,6 @@ def start_play():
             (license_row["id"],),
         ).fetchone()
         updated_status = serialize_license_status(updated)
-        conn.close()
         return jsonify({
             "success": True,
             "message": "播放已开始",
@@ -923,7 +1982,6 @@ def start_play():
         })
     except Exception as exc:
         conn.rollback()
-        conn.close()
         return jsonify({"success": False, "message": f"开始播放失败: {str(exc)}"}), 500
 
 
@@ -936,40 +1994,38 @@ def end_play():
     if not session_id:
         return jsonify({"success": False, "message": "session_id 不能为空"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     session = conn.execute(
         "SELECT * FROM play_sessions WHERE session_id = ?", (session_id,)
     ).fetchone()
     if not session:
-        conn.close()
         return jsonify({"success": False, "message": "未找到播放记录"}), 404
 
     if session["status"] == "ended":
-        conn.close()
         return jsonify({"success": True, "message": "播放已结束"})
 
     now = utc_now_iso()
-    started_at = parse_date_or_datetime(session["started_at"])
+    now_ts = iso_to_epoch(now)
     duration_seconds = None
-    if started_at:
-        duration_seconds = max(
-            0, int((datetime.datetime.now() - started_at).total_seconds())
-        )
+    if session["started_at_ts"] is not None:
+        duration_seconds = max(0, now_ts - session["started_at_ts"])
 
     conn.execute(
         """
         UPDATE play_sessions
         SET ended_at = ?,
+            ended_at_ts = ?,
             last_heartbeat_at = ?,
+            last_heartbeat_at_ts = ?,
             duration_seconds = ?,
             status = 'ended',
             remarks = COALESCE(?, remarks)
         WHERE session_id = ?
         """,
-        (now, now, duration_seconds, remarks, session_id),
+        (now, now_ts, now, now_ts, duration_seconds, remarks, session_id),
     )
     conn.commit()
-    conn.close()
+    heartbeat_buffer.forget(session_id)
     return jsonify({
         "success": True,
         "message": "播放已结束",
@@ -985,37 +2041,93 @@ def play_heartbeat():
     if not session_id:
         return jsonify({"success": False, "message": "session_id 不能为空"}), 400
 
-    conn = get_db_connection()
-    session = conn.execute(
-        "SELECT status FROM play_sessions WHERE session_id = ?", (session_id,)
-    ).fetchone()
-    if not session:
-        conn.close()
-        return jsonify({"success": False, "message": "未找到播放记录"}), 404
+    # Sessions recently confirmed as playing skip the database entirely; the
+    # timestamp is buffered and written in batches by heartbeat_buffer.
+    if not heartbeat_buffer.is_playing(session_id):
+        conn = get_db()
+        session = conn.execute(
+            "SELECT status FROM play_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if not session:
+            return jsonify({"success": False, "message": "未找到播放记录"}), 404
 
-    if session["status"] != "playing":
-        conn.close()
-        return jsonify({"success": False, "message": "播放记录已结束"}), 409
+        if session["status"] != "playing":
+            heartbeat_buffer.forget(session_id)
+            return jsonify({"success": False, "message": "播放记录已结束"}), 409
 
-    conn.execute(
-        "UPDATE play_sessions SET last_heartbeat_at = ? WHERE session_id = ?",
-        (utc_now_iso(), session_id),
-    )
-    conn.commit()
-    conn.close()
+        heartbeat_buffer.mark_playing(session_id)
+
+    heartbeat_buffer.record(session_id, utc_now_iso())
     return jsonify({"success": True, "message": "心跳已记录"})
 
 
 # --- Admin Management API ---
+@app.route("/api/admin/cache", methods=["GET"])
+@require_admin_token
+def get_cache_stats():
+    """Hit/miss/eviction counters of the client license cache"""
+    return jsonify({"license_cache": license_cache.stats()})
+
+
+SLOW_QUERY_ORDERS = {
+    "total": "total_seconds",
+    "max": "max_seconds",
+    "calls": "calls",
+    "slow": "slow_calls",
+}
+
+
+@app.route("/api/admin/slow-queries", methods=["GET"])
+@require_admin_token
+def get_slow_queries():
+    """Top-N statements of this worker process by total time (or max/calls/slow)"""
+    order = request.args.get("order", "total")
+    if order not in SLOW_QUERY_ORDERS:
+        return jsonify({"message": "order 仅支持 total、max、calls、slow"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 500)
+    except ValueError:
+        return jsonify({"message": "limit 必须是整数"}), 400
+    return jsonify(
+        {
+            **query_log.stats(),
+            "pid": os.getpid(),
+            "queries": query_log.top(limit, SLOW_QUERY_ORDERS[order]),
+        }
+    )
+
+
+@app.route("/api/admin/slow-queries", methods=["DELETE"])
+@require_admin_token
+def reset_slow_queries():
+    query_log.reset()
+    return jsonify({"success": True, "message": "查询统计已清空"})
+
+
+@app.route("/metrics", methods=["GET"])
+@require_admin_token
+def get_metrics():
+    """Prometheus text format: per-route requests, latency, DB time and runtime stats"""
+    counters, histograms = metrics.collect()
+    conn = get_db()
+    # Open sessions per project come from the trigger-maintained project_stats.
+    for row in conn.execute("SELECT project_id, playing FROM project_stats"):
+        labels = (("project_id", str(row["project_id"])),)
+        counters[("keyhub_playing_sessions", labels)] = row["playing"]
+    return Response(
+        metrics.render(counters, histograms), mimetype="text/plain; version=0.0.4"
+    )
+
+
+
 @app.route("/api/admin/users", methods=["GET"])
 @require_admin_token
 def get_admin_users():
     """Get all admin users"""
-    conn = get_db_connection()
+    conn = get_db()
     users = conn.execute(
         "SELECT id, username, created_at FROM admin_users ORDER BY created_at DESC"
     ).fetchall()
-    conn.close()
     return jsonify([dict(u) for u in users])
 
 
@@ -1030,14 +2142,13 @@ def create_admin_user():
     if not username or not password:
         return jsonify({"error": "用户名和密码不能为空"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
     try:
         # Check if username already exists
         existing = conn.execute(
             "SELECT id FROM admin_users WHERE username = ?", (username,)
         ).fetchone()
         if existing:
-            conn.close()
             return jsonify({"error": "用户名已存在"}), 400
 
         now = datetime.datetime.now().isoformat()
@@ -1046,10 +2157,9 @@ def create_admin_user():
             (username, password, now),
         )
         conn.commit()
-        conn.close()
+        invalidate_admin_token_index()
         return jsonify({"success": True, "message": "管理员创建成功"})
     except Exception as e:
-        conn.close()
         return jsonify({"error": f"创建失败: {str(e)}"}), 500
 
 
@@ -1057,11 +2167,10 @@ def create_admin_user():
 @require_admin_token
 def delete_admin_user(username):
     """Delete an admin user"""
-    conn = get_db_connection()
+    conn = get_db()
 
     # Check if it's the default admin
     if username == "admin":
-        conn.close()
         return jsonify({"error": "不能删除默认管理员账户"}), 403
 
     # Check if it's the last admin
@@ -1069,7 +2178,6 @@ def delete_admin_user(username):
         "count"
     ]
     if admin_count <= 1:
-        conn.close()
         return jsonify({"error": "不能删除最后一个管理员账户"}), 403
 
     # Check if user exists
@@ -1077,12 +2185,11 @@ def delete_admin_user(username):
         "SELECT id FROM admin_users WHERE username = ?", (username,)
     ).fetchone()
     if not user:
-        conn.close()
         return jsonify({"error": "用户不存在"}), 404
 
     conn.execute("DELETE FROM admin_users WHERE username = ?", (username,))
     conn.commit()
-    conn.close()
+    invalidate_admin_token_index()
     return jsonify({"success": True, "message": "管理员已删除"})
 
 
@@ -1099,14 +2206,13 @@ def update_admin_username(username):
     if username == "admin":
         return jsonify({"error": "不能修改默认管理员的用户名"}), 403
 
-    conn = get_db_connection()
+    conn = get_db()
 
     # Check if user exists
     user = conn.execute(
         "SELECT id FROM admin_users WHERE username = ?", (username,)
     ).fetchone()
     if not user:
-        conn.close()
         return jsonify({"error": "用户不存在"}), 404
 
     # Check if new username already exists
@@ -1114,7 +2220,6 @@ def update_admin_username(username):
         "SELECT id FROM admin_users WHERE username = ?", (new_username,)
     ).fetchone()
     if existing:
-        conn.close()
         return jsonify({"error": "新用户名已存在"}), 400
 
     try:
@@ -1123,10 +2228,9 @@ def update_admin_username(username):
             (new_username, username),
         )
         conn.commit()
-        conn.close()
+        invalidate_admin_token_index()
         return jsonify({"success": True, "message": "用户名已更新"})
     except Exception as e:
-        conn.close()
         return jsonify({"error": f"更新失败: {str(e)}"}), 500
 
 
@@ -1140,14 +2244,13 @@ def update_admin_password(username):
     if not new_password:
         return jsonify({"error": "新密码不能为空"}), 400
 
-    conn = get_db_connection()
+    conn = get_db()
 
     # Check if user exists
     user = conn.execute(
         "SELECT id FROM admin_users WHERE username = ?", (username,)
     ).fetchone()
     if not user:
-        conn.close()
         return jsonify({"error": "用户不存在"}), 404
 
     try:
@@ -1156,10 +2259,9 @@ def update_admin_password(username):
             (new_password, username),
         )
         conn.commit()
-        conn.close()
+        invalidate_admin_token_index()
         return jsonify({"success": True, "message": "密码已更新"})
     except Exception as e:
-        conn.close()
         return jsonify({"error": f"更新失败: {str(e)}"}), 500
 
 
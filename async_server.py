@@ -0,0 +1,259 @@
+"""asyncio front end for the public client endpoints.
+
+Connections (including thousands of idle keep-alive sockets from headsets) are
+handled by one event loop; each request is dispatched to the Flask app on a
+bounded thread pool, so SQLite work never runs on the loop and responses are
+byte-for-byte those of the sync server. Admin routes are not served here; run
+app.py (or the production launcher) alongside for the admin UI.
+
+    python async_server.py --port 5002 --workers 16
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import signal
+import sys
+import urllib.parse
+
+from app import app
+from database import DB_POOL_SIZE
+
+ASYNC_HOST = os.environ.get("KEYHUB_ASYNC_HOST", "0.0.0.0")
+ASYNC_PORT = int(os.environ.get("KEYHUB_ASYNC_PORT", "5002"))
+# Threads running Flask handlers; more than the DB pool would only wait on it.
+ASYNC_WORKERS = int(os.environ.get("KEYHUB_ASYNC_WORKERS", str(DB_POOL_SIZE)))
+# Requests queued for the pool before connections stop being read.
+ASYNC_MAX_PENDING = int(os.environ.get("KEYHUB_ASYNC_MAX_PENDING", "1024"))
+ASYNC_KEEPALIVE_SECONDS = float(os.environ.get("KEYHUB_ASYNC_KEEPALIVE_SECONDS", "75"))
+ASYNC_MAX_HEADER_BYTES = 16 * 1024
+ASYNC_MAX_BODY_BYTES = int(os.environ.get("KEYHUB_ASYNC_MAX_BODY_BYTES", str(1024 * 1024)))
+
+PUBLIC_PATHS = {
+    "/api/verify",
+    "/api/verify/batch",
+    "/api/license/status",
+    "/api/play/start",
+    "/api/play/heartbeat",
+    "/api/play/end",
+    "/api/register",
+}
+
+STATUS_REASONS = {
+    400: "Bad Request",
+    404: "Not Found",
+    408: "Request Timeout",
+    411: "Length Required",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+}
+
+
+class BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def call_wsgi(environ):
+    """Run the Flask app for one request; returns (status, headers, body)."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = status
+        response["headers"] = headers
+
+    result = app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+def json_error(status, message):
+    body = json.dumps({"message": message, "success": False}, ensure_ascii=False).encode()
+    headers = [("Content-Type", "application/json")]
+    return f"{status} {STATUS_REASONS[status]}", headers, body
+
+
+class AsyncServer:
+    def __init__(self, host=ASYNC_HOST, port=ASYNC_PORT, workers=ASYNC_WORKERS):
+        self.host = host
+        self.port = port
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="keyhub-async"
+        )
+        self.pending = None
+        self.server = None
+        self.closing = False
+        self.connections = set()
+        self.idle = set()
+
+    async def serve(self):
+        self.pending = asyncio.Semaphore(ASYNC_MAX_PENDING)
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, limit=ASYNC_MAX_HEADER_BYTES
+        )
+        loop = asyncio.get_running_loop()
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopped.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        print(f"KeyHub 异步服务已启动: http://{self.host}:{self.port}")
+        async with self.server:
+            await stopped.wait()
+            self.server.close()
+            # Idle keep-alive connections are dropped; in-flight requests finish
+            # and then close their connection.
+            self.closing = True
+            for task in list(self.idle):
+                task.cancel()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        peer = writer.get_extra_info("peername") or ("", 0)
+        try:
+            keep_alive = True
+            while keep_alive and not self.closing:
+                self.idle.add(task)
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), ASYNC_KEEPALIVE_SECONDS
+                    )
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.write_response(writer, json_error(431, "请求头过大"), False)
+                    break
+                finally:
+                    self.idle.discard(task)
+
+                try:
+                    environ, keep_alive = await self.read_request(reader, writer, head, peer)
+                except BadRequest as exc:
+                    await self.write_response(writer, json_error(exc.status, str(exc)), False)
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+
+                if environ["PATH_INFO"] not in PUBLIC_PATHS:
+                    response = json_error(404, "该服务仅提供客户端接口")
+                else:
+                    response = await self.dispatch(environ)
+                keep_alive = keep_alive and not self.closing
+                await self.write_response(writer, response, keep_alive)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.idle.discard(task)
+            self.connections.discard(task)
+            writer.close()
+
+    async def read_request(self, reader, writer, head, peer):
+        try:
+            lines = head[:-4].decode("latin-1").split("\r\n")
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise BadRequest(400, "请求格式错误")
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise BadRequest(400, "请求格式错误")
+            headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise BadRequest(411, "需要 Content-Length")
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise BadRequest(400, "Content-Length 无效")
+        if length < 0:
+            raise BadRequest(400, "Content-Length 无效")
+        if length > ASYNC_MAX_BODY_BYTES:
+            raise BadRequest(413, "请求体过大")
+
+        if length and headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        body = b""
+        if length:
+            body = await asyncio.wait_for(reader.readexactly(length), ASYNC_KEEPALIVE_SECONDS)
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        path, _, query = target.partition("?")
+        sockname = writer.get_extra_info("sockname") or (self.host, self.port)
+        environ = {
+            "REQUEST_METHOD": method.upper(),
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": str(sockname[0]),
+            "SERVER_PORT": str(sockname[1]),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": str(peer[0]),
+            "REMOTE_PORT": str(peer[1]),
+            "CONTENT_LENGTH": str(length),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name != "content-length":
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        return environ, keep_alive
+
+    async def dispatch(self, environ):
+        async with self.pending:
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self.executor, call_wsgi, environ)
+            except Exception as exc:
+                print(f"处理请求失败: {exc}")
+                return json_error(500, "服务器内部错误")
+
+    async def write_response(self, writer, response, keep_alive):
+        status, headers, body = response
+        lines = [f"HTTP/1.1 {status}"]
+        for name, value in headers:
+            if name.lower() not in ("content-length", "connection"):
+                lines.append(f"{name}: {value}")
+        lines.append(f"Content-Length: {len(body)}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KeyHub 客户端接口异步服务")
+    parser.add_argument("--host", default=ASYNC_HOST)
+    parser.add_argument("--port", type=int, default=ASYNC_PORT)
+    parser.add_argument("--workers", type=int, default=ASYNC_WORKERS)
+    args = parser.parse_args()
+    asyncio.run(AsyncServer(args.host, args.port, args.workers).serve())
+
+
+if __name__ == "__main__":
+    main()
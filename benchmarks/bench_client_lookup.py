@@ -0,0 +1,175 @@
+"""Benchmark the client license lookup used by verify, license/status and play/start.
+
+Builds a throwaway database with many licenses, then compares the legacy
+OR/JOIN query before and after the (project_id, machine_code) index with
+get_license_for_client: query plans and per-lookup latency, first without
+planner statistics (KeyHub never runs ANALYZE) and then after ANALYZE. The
+database is deleted when the run ends.
+
+    python benchmarks/bench_client_lookup.py --licenses 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LEGACY_QUERY = """
+    SELECT l.*, p.name as project_name, p.project_type as project_type
+    FROM licenses l
+    JOIN projects p ON l.project_id = p.id
+    WHERE (l.license_key = ? OR (p.project_type = 'playback' AND l.machine_code = ?))
+        AND p.name = ?
+"""
+
+
+def legacy_lookup(conn, key_value, project_name):
+    return conn.execute(LEGACY_QUERY, (key_value, key_value, project_name)).fetchone()
+
+
+def populate(conn, licenses, projects):
+    now = "2026-01-01T00:00:00"
+    conn.executemany(
+        "INSERT INTO projects (name, description, created_at, project_type) VALUES (?, '', ?, ?)",
+        [
+            (f"bench-{i}", now, "playback" if i % 2 else "activation")
+            for i in range(projects)
+        ],
+    )
+    project_rows = conn.execute(
+        "SELECT id, name, project_type FROM projects WHERE name LIKE 'bench-%'"
+    ).fetchall()
+
+    batch = []
+    for i in range(licenses):
+        project = project_rows[i % len(project_rows)]
+        key = f"KH-{i:08X}-BENCH"
+        machine_code = f"MC-{i:012d}" if project["project_type"] == "playback" else None
+        batch.append((project["id"], key, now, machine_code))
+        if len(batch) == 10000:
+            conn.executemany(
+                "INSERT INTO licenses (project_id, license_key, created_at, machine_code) "
+                "VALUES (?, ?, ?, ?)",
+                batch,
+            )
+            batch = []
+    if batch:
+        conn.executemany(
+            "INSERT INTO licenses (project_id, license_key, created_at, machine_code) "
+            "VALUES (?, ?, ?, ?)",
+            batch,
+        )
+    conn.commit()
+    return project_rows
+
+
+def sample_lookups(project_rows, licenses, count, seed):
+    rng = random.Random(seed)
+    lookups = []
+    for _ in range(count):
+        i = rng.randrange(licenses)
+        project = project_rows[i % len(project_rows)]
+        if project["project_type"] == "playback" and rng.random() < 0.5:
+            lookups.append((f"MC-{i:012d}", project["name"]))
+        else:
+            lookups.append((f"KH-{i:08X}-BENCH", project["name"]))
+    return lookups
+
+
+def measure(func, conn, lookups):
+    timings = []
+    for key_value, project_name in lookups:
+        start = time.perf_counter()
+        row = func(conn, key_value, project_name)
+        timings.append(time.perf_counter() - start)
+        if row is None:
+            raise RuntimeError(f"lookup failed: {project_name}/{key_value}")
+    timings.sort()
+    return {
+        "mean_us": sum(timings) / len(timings) * 1e6,
+        "p50_us": timings[len(timings) // 2] * 1e6,
+        "p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+    }
+
+
+def report(name, result):
+    print(
+        f"  {name:8} mean {result['mean_us']:10.1f}us"
+        f"  p50 {result['p50_us']:10.1f}us  p99 {result['p99_us']:10.1f}us"
+    )
+
+
+def print_plan(conn, title, sql, params):
+    print(f"  {title}")
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+        print(f"    {row[3]}")
+
+
+def run(args, workdir):
+    os.environ["KEYHUB_DB_PATH"] = os.path.join(workdir, "keyhub.db")
+    os.environ["KEYHUB_ARCHIVE_DB_PATH"] = os.path.join(workdir, "keyhub_archive.db")
+    os.environ["KEYHUB_MAINTENANCE"] = "0"
+    sys.path.insert(0, ROOT_DIR)
+    import database
+    from app import (
+        CLIENT_LICENSE_BY_KEY_QUERY,
+        CLIENT_LICENSE_BY_MACHINE_QUERY,
+        get_license_for_client,
+    )
+
+    conn = database.get_db_connection()
+    try:
+        print(f"Populating {args.licenses} licenses in {args.projects} projects ({workdir})")
+        started = time.perf_counter()
+        project_rows = populate(conn, args.licenses, args.projects)
+        print(f"  done in {time.perf_counter() - started:.1f}s\n")
+
+        playback = next(p for p in project_rows if p["project_type"] == "playback")
+        lookups = sample_lookups(project_rows, args.licenses, args.lookups, args.seed)
+
+        # Baseline: the legacy query with only the indexes that existed before the
+        # (project_id, machine_code) migration.
+        conn.execute("DROP INDEX idx_licenses_project_machine")
+        print("Before migration")
+        print_plan(conn, "legacy OR/JOIN", LEGACY_QUERY, ("MC-1", "MC-1", playback["name"]))
+        report("legacy", measure(legacy_lookup, conn, lookups))
+
+        conn.execute(
+            "CREATE INDEX idx_licenses_project_machine ON licenses(project_id, machine_code)"
+        )
+        # Without sqlite_stat1 the planner may answer the OR through the
+        # project_id index alone; each probe has exactly one matching index.
+        for title, analyze in (("no statistics", False), ("after ANALYZE", True)):
+            if analyze:
+                conn.execute("ANALYZE")
+            print(f"\nAfter migration, {title}")
+            print_plan(conn, "legacy OR/JOIN", LEGACY_QUERY, ("MC-1", "MC-1", playback["name"]))
+            print_plan(
+                conn, "key probe", CLIENT_LICENSE_BY_KEY_QUERY, (playback["name"], "MC-1")
+            )
+            print_plan(
+                conn, "machine probe", CLIENT_LICENSE_BY_MACHINE_QUERY, (playback["name"], "MC-1")
+            )
+            report("legacy", measure(legacy_lookup, conn, lookups))
+            report("current", measure(get_license_for_client, conn, lookups))
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--licenses", type=int, default=1_000_000)
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="keyhub-bench-") as workdir:
+        run(args, workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Microbenchmarks for the per-request helpers in app.py.
+
+Times each helper on representative inputs with timeit (best and median of
+several repeats, auto-calibrated loop counts) and measures the peak memory
+allocated by a single call with tracemalloc. Runs offline against a
+throwaway database that is deleted afterwards; save results with --save and
+compare two commits with --compare.
+
+    python benchmarks/bench_helpers.py --save before.json
+    python benchmarks/bench_helpers.py --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LICENSE_ROW = {
+    "id": 42,
+    "license_key": "KH-0123ABCD-4567EF89",
+    "project_id": 3,
+    "project_name": "VR Arcade",
+    "project_type": "playback",
+    "is_active": 1,
+    "auth_type": "unlimited",
+    "remaining_plays": None,
+    "valid_until": None,
+    "machine_code": "MC-000000001234",
+    "last_play_started_at": "2026-03-01T12:00:00.123456",
+}
+
+LICENSE_ROWS = {
+    "unlimited": LICENSE_ROW,
+    "count_date": dict(
+        LICENSE_ROW, auth_type="count_date", remaining_plays=12, valid_until="2099-12-31"
+    ),
+    "expired": dict(LICENSE_ROW, auth_type="date", valid_until="2020-01-01T08:30:00"),
+    "disabled": dict(LICENSE_ROW, is_active=0),
+}
+
+REQUEST_HEADERS = {
+    "X-Forwarded-For": "10.0.0.7, 172.16.3.2, 203.0.113.50",
+    "X-Real-IP": "10.0.0.7",
+}
+
+
+def load_app(workdir):
+    os.environ["KEYHUB_DB_PATH"] = os.path.join(workdir, "keyhub.db")
+    os.environ["KEYHUB_ARCHIVE_DB_PATH"] = os.path.join(workdir, "keyhub_archive.db")
+    os.environ["KEYHUB_MAINTENANCE"] = "0"
+    sys.path.insert(0, ROOT_DIR)
+    import app
+
+    return app
+
+
+def build_cases(app):
+    """(name, callable) pairs; every callable takes no arguments."""
+    # Rows as read from the database carry the epoch column next to valid_until.
+    rows = {
+        label: dict(row, valid_until_ts=app.iso_to_epoch(row["valid_until"], end_of_day=True))
+        for label, row in LICENSE_ROWS.items()
+    }
+    cases = []
+    for label, row in rows.items():
+        cases.append((f"serialize_license_status[{label}]", lambda row=row: app.serialize_license_status(row)))
+    for label, row in (("none", rows["unlimited"]), ("date", rows["count_date"]),
+                       ("datetime", rows["expired"])):
+        cases.append((f"is_license_expired[{label}]", lambda row=row: app.is_license_expired(row)))
+    for label, value in (("date", "2099-12-31"), ("datetime", "2026-03-01T12:00:00"),
+                         ("micro", "2026-03-01T12:00:00.123456"), ("invalid", "31/12/2099")):
+        cases.append((f"parse_date_or_datetime[{label}]", lambda value=value: app.parse_date_or_datetime(value)))
+    for label, value in (("ipv4", "203.0.113.50"), ("ipv4_port", "203.0.113.50:8443"),
+                         ("ipv6_port", "[2001:db8::1]:443"), ("invalid", "unknown")):
+        cases.append((f"normalize_ip_address[{label}]", lambda value=value: app.normalize_ip_address(value)))
+    for label, value in (("private", "10.0.0.7"), ("public", "203.0.113.50"), ("ipv6", "2606:4700::1111")):
+        cases.append((f"is_public_ip[{label}]", lambda value=value: app.is_public_ip(value)))
+    cases.append(("get_request_public_ip[forwarded]", app.get_request_public_ip))
+    cases.append(("generate_key", app.generate_key))
+    cases.append(("generate_admin_token", lambda: app.generate_admin_token("admin", "admin123")))
+    return cases
+
+
+def time_case(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    runs = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "loops": number,
+        "best_ns": min(runs) * 1e9,
+        "median_ns": statistics.median(runs) * 1e9,
+    }
+
+
+def measure_allocations(func, calls=200):
+    """Median peak of bytes allocated while one call runs (transient included)."""
+    func()  # warm caches so one-time allocations are not counted
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+    return statistics.median(peaks)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    header = f"{'benchmark':42} {'best ns':>10} {'median ns':>10} {'peak B':>8}"
+    if previous:
+        header += f" {'vs prev':>8}"
+    print(header)
+    for name, row in results.items():
+        line = f"{name:42} {row['best_ns']:10.0f} {row['median_ns']:10.0f} {row['peak_bytes']:8.0f}"
+        if previous:
+            old = previous.get(name)
+            line += f" {row['best_ns'] / old['best_ns']:7.2f}x" if old else f" {'new':>8}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--save", help="write results JSON to this path")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="keyhub-microbench-") as workdir:
+        app = load_app(workdir)
+        cases = build_cases(app)
+        if args.filter:
+            cases = [(name, func) for name, func in cases if args.filter in name]
+
+        results = {}
+        # get_request_public_ip reads flask.request; the context is entered once so
+        # only the helper itself is timed.
+        with app.app.test_request_context(
+            "/api/play/start", method="POST", headers=REQUEST_HEADERS,
+            environ_base={"REMOTE_ADDR": "127.0.0.1"},
+        ):
+            for name, func in cases:
+                results[name] = dict(
+                    time_case(func, args.repeat), peak_bytes=measure_allocations(func)
+                )
+        app.db_pool.close_all()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)["results"]
+    print_results(results, previous)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "revision": git_revision(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"\nSaved results to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""End-to-end load test of the client endpoints.
+
+Starts KeyHub (serve.py or async_server.py) against a throwaway database seeded
+with playback licenses, drives a weighted mix of verify, license/status,
+play/start, play/heartbeat and play/end at a target request rate (or as fast
+as possible) and reports throughput, latency percentiles and error rates per
+endpoint. Results can be saved as JSON and compared against a baseline; the
+exit status is 1 when the comparison finds a regression.
+
+No baseline is shipped, since throughput and latency depend on the machine.
+Record one with --save on the target host first (e.g. at the last release),
+then pass it to --baseline on later runs with the same options:
+
+    python benchmarks/load_test.py --duration 30 --rps 500 --concurrency 64 \\
+        --save baseline.json
+    python benchmarks/load_test.py --duration 30 --rps 500 --concurrency 64 \\
+        --save results.json --baseline baseline.json
+
+With --rps, latency is measured from each request's scheduled start, so time
+spent queued behind a slow server counts against it.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_NAME = "loadtest"
+DEFAULT_MIX = "verify=35,status=20,start=15,heartbeat=25,end=5"
+ENDPOINTS = {
+    "verify": "/api/verify",
+    "status": "/api/license/status",
+    "start": "/api/play/start",
+    "heartbeat": "/api/play/heartbeat",
+    "end": "/api/play/end",
+}
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint in mix: {name}")
+        mix[name] = float(weight)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("mix weights must not all be zero")
+    return mix
+
+
+def seed_database(licenses):
+    import database
+
+    database.init_db()
+    conn = database.get_db_connection()
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    conn.execute(
+        "INSERT INTO projects (name, description, created_at, project_type) "
+        "VALUES (?, 'load test', ?, 'playback')",
+        (PROJECT_NAME, now),
+    )
+    project_id = conn.execute(
+        "SELECT id FROM projects WHERE name = ?", (PROJECT_NAME,)
+    ).fetchone()[0]
+    keys = [f"LT-{i:08d}" for i in range(licenses)]
+    conn.executemany(
+        "INSERT INTO licenses (project_id, license_key, created_at, auth_type, machine_code) "
+        "VALUES (?, ?, ?, 'unlimited', ?)",
+        [(project_id, key, now, key) for key in keys],
+    )
+    conn.commit()
+    conn.close()
+    return keys
+
+
+def start_server(args, env):
+    if args.server == "async":
+        command = [
+            sys.executable, os.path.join(ROOT_DIR, "async_server.py"),
+            "--host", "127.0.0.1", "--port", str(args.port),
+            "--workers", str(args.threads),
+        ]
+    else:
+        command = [
+            sys.executable, os.path.join(ROOT_DIR, "serve.py"),
+            "--bind", f"127.0.0.1:{args.port}",
+            "--workers", str(args.workers), "--threads", str(args.threads),
+        ]
+    server = subprocess.Popen(command, cwd=ROOT_DIR, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"server exited with status {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit("server did not start within 30s")
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+class Sessions:
+    """Play sessions started by the load test and not yet ended."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = []
+
+    def add(self, session_id):
+        with self._lock:
+            self._active.append(session_id)
+
+    def pick(self, rng):
+        with self._lock:
+            return rng.choice(self._active) if self._active else None
+
+    def pop(self, rng):
+        with self._lock:
+            if not self._active:
+                return None
+            index = rng.randrange(len(self._active))
+            self._active[index], self._active[-1] = self._active[-1], self._active[index]
+            return self._active.pop()
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.errors = {name: {} for name in ENDPOINTS}
+
+    def record(self, name, latency, error=None):
+        with self._lock:
+            self.latencies[name].append(latency)
+            if error is not None:
+                self.errors[name][error] = self.errors[name].get(error, 0) + 1
+
+
+class LoadGenerator:
+    def __init__(self, args, keys):
+        self.args = args
+        self.keys = keys
+        self.sessions = Sessions()
+        self.recorder = Recorder()
+        self.names = list(args.mix)
+        self.weights = [args.mix[name] for name in self.names]
+        self._counter = itertools.count()
+        self._counter_lock = threading.Lock()
+
+    def run(self, duration, record=True):
+        self.started = time.perf_counter()
+        self.deadline = self.started + duration
+        self.record = record
+        with self._counter_lock:
+            self._counter = itertools.count()
+        threads = [
+            threading.Thread(target=self.worker, args=(index,), daemon=True)
+            for index in range(self.args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - self.started
+
+    def next_slot(self):
+        """Scheduled start of the next request, or None when the run is over."""
+        if not self.args.rps:
+            now = time.perf_counter()
+            return now if now < self.deadline else None
+        with self._counter_lock:
+            index = next(self._counter)
+        scheduled = self.started + index / self.args.rps
+        return scheduled if scheduled < self.deadline else None
+
+    def worker(self, index):
+        rng = random.Random(self.args.seed * 1000 + index)
+        conn = http.client.HTTPConnection("127.0.0.1", self.args.port, timeout=30)
+        while True:
+            scheduled = self.next_slot()
+            if scheduled is None:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            name, body = self.next_request(rng)
+            error = None
+            try:
+                status, payload = self.post(conn, ENDPOINTS[name], body)
+                if status != 200:
+                    error = str(status)
+                elif name == "start":
+                    self.sessions.add(payload["session_id"])
+            except (OSError, http.client.HTTPException, ValueError) as exc:
+                error = type(exc).__name__
+                conn.close()
+            if self.record:
+                self.recorder.record(name, time.perf_counter() - scheduled, error)
+        conn.close()
+
+    def next_request(self, rng):
+        name = rng.choices(self.names, self.weights)[0]
+        if name in ("heartbeat", "end"):
+            if name == "end":
+                session_id = self.sessions.pop(rng)
+            else:
+                session_id = self.sessions.pick(rng)
+            if session_id:
+                return name, {"session_id": session_id}
+            name = "start"
+        key = rng.choice(self.keys)
+        return name, {"key": key, "project_name": PROJECT_NAME, "machine_code": key}
+
+    def post(self, conn, path, body):
+        conn.request(
+            "POST", path, body=json.dumps(body), headers={"Content-Type": "application/json"}
+        )
+        response = conn.getresponse()
+        payload = json.loads(response.read() or b"{}")
+        if response.will_close:
+            conn.close()
+        return response.status, payload
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    all_latencies = []
+    all_errors = 0
+    for name, latencies in recorder.latencies.items():
+        if not latencies:
+            continue
+        latencies = sorted(latencies)
+        all_latencies.extend(latencies)
+        errors = sum(recorder.errors[name].values())
+        all_errors += errors
+        endpoints[name] = {
+            "requests": len(latencies),
+            "throughput_rps": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "error_rate": errors / len(latencies),
+            "errors": recorder.errors[name],
+        }
+    all_latencies.sort()
+    total = {
+        "requests": len(all_latencies),
+        "throughput_rps": len(all_latencies) / elapsed,
+        "p50_ms": percentile(all_latencies, 0.50) * 1000,
+        "p95_ms": percentile(all_latencies, 0.95) * 1000,
+        "p99_ms": percentile(all_latencies, 0.99) * 1000,
+        "max_ms": all_latencies[-1] * 1000 if all_latencies else 0.0,
+        "error_rate": all_errors / len(all_latencies) if all_latencies else 0.0,
+    }
+    return endpoints, total
+
+
+def print_report(endpoints, total):
+    print(
+        f"\n{'endpoint':10} {'requests':>9} {'rps':>9} {'p50 ms':>9} "
+        f"{'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>8}"
+    )
+    for name, row in list(endpoints.items()) + [("total", total)]:
+        print(
+            f"{name:10} {row['requests']:9d} {row['throughput_rps']:9.1f} "
+            f"{row['p50_ms']:9.2f} {row['p95_ms']:9.2f} {row['p99_ms']:9.2f} "
+            f"{row['max_ms']:9.2f} {row['error_rate']:8.2%}"
+        )
+
+
+def compare(result, baseline, tolerance):
+    """Print regressions against a baseline result; returns True if any."""
+    regressions = []
+    current_rows = dict(result["endpoints"], total=result["total"])
+    baseline_rows = dict(baseline["endpoints"], total=baseline["total"])
+    for name, base in baseline_rows.items():
+        row = current_rows.get(name)
+        if row is None:
+            continue
+        for metric in ("p95_ms", "p99_ms"):
+            if base[metric] and row[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {base[metric]:.2f} -> {row[metric]:.2f}")
+        if row["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name} throughput_rps: {base['throughput_rps']:.1f} -> {row['throughput_rps']:.1f}"
+            )
+        if row["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(
+                f"{name} error_rate: {base['error_rate']:.2%} -> {row['error_rate']:.2%}"
+            )
+
+    print(f"\nBaseline comparison (tolerance {tolerance:.0%})")
+    if result["config"] != baseline["config"]:
+        print("  note: run configuration differs from the baseline's")
+    for line in regressions or ["  no regressions"]:
+        print(f"  {line}")
+    return bool(regressions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["serve", "async"], default="serve")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--workers", type=int, default=2, help="serve.py processes")
+    parser.add_argument("--threads", type=int, default=16, help="threads per process")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--rps", type=float, default=0, help="target rate; 0 = closed loop")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--licenses", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write results JSON to this path")
+    parser.add_argument("--baseline", help="compare against this results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="keyhub-load-") as workdir:
+        env = dict(
+            os.environ,
+            KEYHUB_DB_PATH=os.path.join(workdir, "keyhub.db"),
+            KEYHUB_ARCHIVE_DB_PATH=os.path.join(workdir, "keyhub_archive.db"),
+            KEYHUB_STATUS_PATH=os.path.join(workdir, "workers.json"),
+            KEYHUB_METRICS_DIR=os.path.join(workdir, "metrics"),
+            KEYHUB_RATE_LIMIT_DB_PATH=os.path.join(workdir, "keyhub_ratelimit.db"),
+            # All load comes from one address; measure the server, not the limiter.
+            KEYHUB_RATE_LIMIT=os.environ.get("KEYHUB_RATE_LIMIT", "0"),
+        )
+        os.environ.update(env)
+        sys.path.insert(0, ROOT_DIR)
+        print(f"Seeding {args.licenses} licenses in {workdir}")
+        keys = seed_database(args.licenses)
+
+        server = start_server(args, env)
+        try:
+            generator = LoadGenerator(args, keys)
+            if args.warmup:
+                generator.run(args.warmup, record=False)
+            print(f"Running {args.duration:.0f}s against {args.server} "
+                  f"(rps={args.rps or 'max'}, concurrency={args.concurrency})")
+            elapsed = generator.run(args.duration)
+        finally:
+            stop_server(server)
+
+    endpoints, total = summarize(generator.recorder, elapsed)
+    print_report(endpoints, total)
+    result = {
+        "config": {
+            "server": args.server,
+            "workers": args.workers,
+            "threads": args.threads,
+            "duration": args.duration,
+            "rps": args.rps,
+            "concurrency": args.concurrency,
+            "mix": args.mix,
+            "licenses": args.licenses,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "endpoints": endpoints,
+        "total": total,
+    }
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a fixed TTL.
+
+    Entries can carry tags (e.g. ("license", 12)) so that writes invalidate exactly
+    the entries derived from the rows they touch.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._tags = {}
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            expires_at, value, _tags = entry
+            if time.monotonic() >= expires_at:
+                self._remove(key)
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return value
+
+    def set(self, key, value, tags=()):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._counters["evictions"] += 1
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of the given tags."""
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self._counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        _expires_at, _value, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hit_ratio": self._counters["hits"] / lookups if lookups else 0.0,
+            }
@@ -1,6 +1,13 @@
 import sqlite3
 import datetime
 import os
+import threading
+import time
+import contextlib
+import collections
+
+from metrics import metrics
+from query_log import query_log
 
 # Database path moved into dedicated folder to keep data isolated
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -8,19 +15,439 @@ DB_DIR = os.path.join(BASE_DIR, "db")
 LEGACY_DB_PATH = os.path.join(BASE_DIR, "keyhub.db")
 DB_PATH = os.path.join(DB_DIR, "keyhub.db")
 
+# KEYHUB_DB_PATH points the app at another database (benchmarks, test instances)
+if os.environ.get("KEYHUB_DB_PATH"):
+    DB_PATH = os.path.abspath(os.environ["KEYHUB_DB_PATH"])
+    DB_DIR = os.path.dirname(DB_PATH)
+
 # Ensure db directory exists and migrate old db file if necessary
 os.makedirs(DB_DIR, exist_ok=True)
-if os.path.exists(LEGACY_DB_PATH) and not os.path.exists(DB_PATH):
+if (
+    not os.environ.get("KEYHUB_DB_PATH")
+    and os.path.exists(LEGACY_DB_PATH)
+    and not os.path.exists(DB_PATH)
+):
     os.replace(LEGACY_DB_PATH, DB_PATH)
 
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+# Closed play sessions older than KEYHUB_ARCHIVE_AFTER_DAYS are moved into this
+# database, attached to every connection as "archive" (see maintenance.py).
+ARCHIVE_DB_PATH = os.path.abspath(
+    os.environ.get("KEYHUB_ARCHIVE_DB_PATH") or os.path.join(DB_DIR, "keyhub_archive.db")
+)
+
+# Connection pool settings (overridable through environment variables)
+DB_POOL_SIZE = int(os.environ.get("KEYHUB_DB_POOL_SIZE", "16"))
+DB_POOL_TIMEOUT = float(os.environ.get("KEYHUB_DB_POOL_TIMEOUT", "10"))
+
+# Storage profiles. All of them use WAL so readers never wait behind the single
+# writer; they differ in how hard commits are synced and how much memory is used.
+#   durable    - fsync on every commit, survives power loss without losing commits
+#   balanced   - fsync at checkpoints only; a power loss may drop the last commits
+#   throughput - no fsync, large caches; only for disposable or replicated data
+STORAGE_PROFILES = {
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 10000,
+        "cache_size": -16 * 1024,
+        "mmap_size": 0,
+        "wal_autocheckpoint": 1000,
+        "journal_size_limit": 64 * 1024 * 1024,
+        "temp_store": "DEFAULT",
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -32 * 1024,
+        "mmap_size": 128 * 1024 * 1024,
+        "wal_autocheckpoint": 1000,
+        "journal_size_limit": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+    "throughput": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "busy_timeout": 5000,
+        "cache_size": -128 * 1024,
+        "mmap_size": 512 * 1024 * 1024,
+        "wal_autocheckpoint": 10000,
+        "journal_size_limit": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+
+# Per-setting overrides on top of the selected profile
+STORAGE_OVERRIDES = {
+    "busy_timeout": "KEYHUB_DB_BUSY_TIMEOUT_MS",
+    "cache_size": "KEYHUB_DB_CACHE_SIZE",
+    "mmap_size": "KEYHUB_DB_MMAP_SIZE",
+    "wal_autocheckpoint": "KEYHUB_DB_WAL_AUTOCHECKPOINT",
+    "journal_size_limit": "KEYHUB_DB_JOURNAL_SIZE_LIMIT",
+}
+
+# Extra retries (with exponential backoff) for BEGIN IMMEDIATE after SQLite's own
+# busy handler has already waited busy_timeout milliseconds.
+DB_BUSY_RETRIES = int(os.environ.get("KEYHUB_DB_BUSY_RETRIES", "3"))
+DB_BUSY_BACKOFF = float(os.environ.get("KEYHUB_DB_BUSY_BACKOFF", "0.05"))
+
+
+def load_storage_settings(profile=None):
+    profile = profile or os.environ.get("KEYHUB_STORAGE_PROFILE", "balanced")
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(f"未知的存储配置: {profile}")
+
+    settings = dict(STORAGE_PROFILES[profile], profile=profile)
+    for name, env_name in STORAGE_OVERRIDES.items():
+        value = os.environ.get(env_name)
+        if value not in (None, ""):
+            settings[name] = int(value)
+    return settings
+
+
+STORAGE_SETTINGS = load_storage_settings()
+
+# Pragmas that only affect the connection they are issued on
+CONNECTION_PRAGMAS = (
+    "synchronous",
+    "cache_size",
+    "mmap_size",
+    "wal_autocheckpoint",
+    "journal_size_limit",
+    "temp_store",
+)
+
+
+# Rows are read this many at a time when a cursor is iterated, and fetch time is
+# reported once it adds up to FETCH_REPORT_SECONDS or the rows run out, so a
+# point lookup or a long export does not pay for a report per fetch.
+FETCH_BATCH_ROWS = 256
+FETCH_REPORT_SECONDS = 0.001
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that adds the time spent fetching rows to its statement's duration.
+
+    execute() returns once the first row is ready; for large results most of
+    the work happens while the rows are fetched. Less than FETCH_REPORT_SECONDS
+    left on a cursor that is dropped before its last row is not counted.
+    Iteration reads rows in batches; the fetch methods take buffered rows first,
+    so iterating and fetching can still be mixed.
+    """
+
+    _sql = None
+
+    def _track(self, sql, parameters, elapsed):
+        self._sql = sql
+        self._parameters = parameters
+        self._reported = elapsed
+        self._elapsed = elapsed
+        self._buffer = collections.deque()
+
+    def _add(self, seconds, done):
+        self._elapsed += seconds
+        extra = self._elapsed - self._reported
+        if extra > 0 and (done or extra >= FETCH_REPORT_SECONDS):
+            metrics.record_db(extra, statements=0)
+            query_log.record(
+                self.connection, self._sql, self._parameters, self._elapsed, previous=self._reported
+            )
+            self._reported = self._elapsed
+
+    def _fetch(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchall() if size is None else super().fetchmany(size)
+        self._add(time.perf_counter() - started, size is None or len(rows) < size)
+        return rows
+
+    def fetchone(self):
+        if self._sql is None:
+            return super().fetchone()
+        if self._buffer:
+            return self._buffer.popleft()
+        rows = self._fetch(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        if self._sql is None:
+            return super().fetchmany(size)
+        rows = [self._buffer.popleft() for _ in range(min(size, len(self._buffer)))]
+        if len(rows) < size:
+            rows.extend(self._fetch(size - len(rows)))
+        return rows
+
+    def fetchall(self):
+        if self._sql is None:
+            return super().fetchall()
+        rows = list(self._buffer)
+        self._buffer.clear()
+        rows.extend(self._fetch())
+        return rows
+
+    def __iter__(self):
+        if self._sql is None:
+            return super().__iter__()
+        return self._iter_rows()
+
+    def __next__(self):
+        if self._sql is None:
+            return super().__next__()
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def _iter_rows(self):
+        buffer = self._buffer
+        while True:
+            if not buffer:
+                rows = self._fetch(FETCH_BATCH_ROWS)
+                if not rows:
+                    return
+                buffer.extend(rows)
+            yield buffer.popleft()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that reports statement and commit time to metrics and the query log."""
+
+    def execute(self, sql, parameters=()):
+        cursor = self.cursor(InstrumentedCursor)
+        started = time.perf_counter()
+        try:
+            cursor.execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.record_db(elapsed)
+            query_log.record(self, sql, parameters, elapsed)
+        cursor._track(sql, parameters, elapsed)
+        return cursor
+
+    def executemany(self, sql, seq_of_parameters):
+        # The first parameter set (when it can be read without consuming an
+        # iterator) is used for the query plan of a slow batch.
+        first = None
+        if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters:
+            first = seq_of_parameters[0]
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.record_db(elapsed)
+            query_log.record(self, sql, first, elapsed)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.record_db(elapsed)
+            query_log.record(self, "COMMIT", (), elapsed)
+
+
+def connect(check_same_thread=True):
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=STORAGE_SETTINGS["busy_timeout"] / 1000,
+        check_same_thread=check_same_thread,
+        factory=InstrumentedConnection,
+    )
     conn.row_factory = sqlite3.Row
     conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute(f'PRAGMA busy_timeout = {STORAGE_SETTINGS["busy_timeout"]}')
+    for name in CONNECTION_PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {STORAGE_SETTINGS[name]}')
+    conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    conn.execute(f'PRAGMA archive.synchronous = {STORAGE_SETTINGS["synchronous"]}')
     return conn
 
 
+def is_busy_error(exc):
+    message = str(exc).lower()
+    return "locked" in message or "busy" in message
+
+
+def begin_immediate(conn):
+    """Start a write transaction, backing off while another writer holds the lock."""
+    delay = DB_BUSY_BACKOFF
+    started = time.perf_counter()
+    try:
+        for attempt in range(DB_BUSY_RETRIES + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as exc:
+                if not is_busy_error(exc) or attempt == DB_BUSY_RETRIES:
+                    raise
+            time.sleep(delay)
+            delay *= 2
+    finally:
+        # Time spent waiting for the write lock, including busy_timeout and backoff.
+        metrics.record_lock_wait(time.perf_counter() - started)
+
+
+def apply_journal_mode(conn):
+    # journal_mode is persistent in the database file; it cannot change inside a
+    # transaction, so it is set once at startup rather than per connection.
+    for schema in ("main", "archive"):
+        mode = conn.execute(
+            f'PRAGMA {schema}.journal_mode = {STORAGE_SETTINGS["journal_mode"]}'
+        ).fetchone()[0]
+        if mode.upper() != STORAGE_SETTINGS["journal_mode"].upper():
+            print(f"无法切换日志模式为 {STORAGE_SETTINGS['journal_mode']}，当前为 {mode}")
+
+
+def get_db_connection():
+    """Open a standalone connection (scripts, migrations). Callers close it."""
+    return connect()
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no pooled connection becomes free within the wait timeout."""
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections.
+
+    Idle connections are kept so that a thread gets back the connection it used
+    last (warm page cache, cached statements) when it is still free. The pool
+    remembers the pid it was created in and discards inherited connections after
+    a fork instead of sharing them with the parent.
+    """
+
+    def __init__(self, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._reset_state()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._open = 0
+        self._in_use = 0
+        self._counters = {
+            "checkouts": 0,
+            "reused": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "opened": 0,
+            "closed": 0,
+        }
+        self._local = threading.local()
+
+    def _after_fork(self):
+        # The parent's lock may have been held by another thread at fork time.
+        self._cond = threading.Condition()
+        self._reset_state()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Connections opened by the parent must not be used (or closed) here.
+            self._reset_state()
+
+    def checkout(self):
+        with self._cond:
+            self._check_pid()
+            self._counters["checkouts"] += 1
+            deadline = None
+            while True:
+                conn = self._take_idle()
+                if conn is not None:
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    try:
+                        conn = connect(check_same_thread=False)
+                    except Exception:
+                        self._open -= 1
+                        raise
+                    self._counters["opened"] += 1
+                    break
+
+                if deadline is None:
+                    self._counters["waits"] += 1
+                    deadline = time.monotonic() + self.timeout
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeout("数据库连接池已满，等待超时")
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._local.last = conn
+            return conn
+
+    def _take_idle(self):
+        if not self._idle:
+            return None
+        last = getattr(self._local, "last", None)
+        if last is not None:
+            for index, conn in enumerate(self._idle):
+                if conn is last:
+                    self._counters["reused"] += 1
+                    return self._idle.pop(index)
+        return self._idle.pop()
+
+    def release(self, conn):
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                self._discard(conn)
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def _discard(self, conn):
+        self._open -= 1
+        self._counters["closed"] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        with self._cond:
+            self._check_pid()
+            while self._idle:
+                self._discard(self._idle.pop())
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a connection outside of a Flask request."""
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._cond:
+            self._check_pid()
+            return {
+                **self._counters,
+                "size": self.size,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+            }
+
+
+db_pool = ConnectionPool()
+
+
 def ensure_column(cursor, table, column, definition):
     cursor.execute(f"PRAGMA table_info({table})")
     columns = [row[1] for row in cursor.fetchall()]
@@ -28,11 +455,421 @@ def ensure_column(cursor, table, column, definition):
         cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 
-def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
+# Denormalized per-project counters, kept current by triggers so that the
+# project stats endpoint does not have to scan licenses. Time-dependent expiry
+# cannot be maintained by triggers and is counted through an index instead.
+# Trigger bodies avoid INSERT OR IGNORE: inside an INSERT ... ON CONFLICT DO
+# UPDATE (license import) the outer statement's conflict handling overrides it.
+# Every project gets its stats row on insert, so the update trigger needs none.
+STATS_COLUMNS = ("total", "active", "disabled", "count_exhausted", "playing")
+
+STATS_TRIGGERS = {
+    "trg_projects_stats_insert": '''
+        AFTER INSERT ON projects BEGIN
+            INSERT INTO project_stats (project_id) SELECT NEW.id
+            WHERE NOT EXISTS (SELECT 1 FROM project_stats WHERE project_id = NEW.id);
+        END
+    ''',
+    "trg_licenses_stats_insert": '''
+        AFTER INSERT ON licenses BEGIN
+            INSERT INTO project_stats (project_id) SELECT NEW.project_id
+            WHERE NOT EXISTS (SELECT 1 FROM project_stats WHERE project_id = NEW.project_id);
+            UPDATE project_stats SET
+                total = total + 1,
+                active = active + (COALESCE(NEW.is_active, 0) != 0),
+                disabled = disabled + (COALESCE(NEW.is_active, 0) = 0),
+                count_exhausted = count_exhausted + (
+                    NEW.auth_type IN ('count', 'count_date')
+                    AND COALESCE(NEW.remaining_plays, 0) <= 0
+                )
+            WHERE project_id = NEW.project_id;
+        END
+    ''',
+    "trg_licenses_stats_update": '''
+        AFTER UPDATE OF project_id, is_active, auth_type, remaining_plays ON licenses BEGIN
+            UPDATE project_stats SET
+                total = total - 1,
+                active = active - (COALESCE(OLD.is_active, 0) != 0),
+                disabled = disabled - (COALESCE(OLD.is_active, 0) = 0),
+                count_exhausted = count_exhausted - (
+                    OLD.auth_type IN ('count', 'count_date')
+                    AND COALESCE(OLD.remaining_plays, 0) <= 0
+                )
+            WHERE project_id = OLD.project_id;
+            UPDATE project_stats SET
+                total = total + 1,
+                active = active + (COALESCE(NEW.is_active, 0) != 0),
+                disabled = disabled + (COALESCE(NEW.is_active, 0) = 0),
+                count_exhausted = count_exhausted + (
+                    NEW.auth_type IN ('count', 'count_date')
+                    AND COALESCE(NEW.remaining_plays, 0) <= 0
+                )
+            WHERE project_id = NEW.project_id;
+        END
+    ''',
+    "trg_licenses_stats_delete": '''
+        AFTER DELETE ON licenses BEGIN
+            UPDATE project_stats SET
+                total = total - 1,
+                active = active - (COALESCE(OLD.is_active, 0) != 0),
+                disabled = disabled - (COALESCE(OLD.is_active, 0) = 0),
+                count_exhausted = count_exhausted - (
+                    OLD.auth_type IN ('count', 'count_date')
+                    AND COALESCE(OLD.remaining_plays, 0) <= 0
+                )
+            WHERE project_id = OLD.project_id;
+        END
+    ''',
+    "trg_play_sessions_stats_insert": '''
+        AFTER INSERT ON play_sessions WHEN NEW.status = 'playing' BEGIN
+            UPDATE project_stats SET playing = playing + 1
+            WHERE project_id = NEW.project_id;
+        END
+    ''',
+    "trg_play_sessions_stats_update": '''
+        AFTER UPDATE OF status ON play_sessions
+        WHEN (OLD.status = 'playing') != (NEW.status = 'playing') BEGIN
+            UPDATE project_stats
+            SET playing = playing + (NEW.status = 'playing') - (OLD.status = 'playing')
+            WHERE project_id = NEW.project_id;
+        END
+    ''',
+    "trg_play_sessions_stats_delete": '''
+        AFTER DELETE ON play_sessions WHEN OLD.status = 'playing' BEGIN
+            UPDATE project_stats SET playing = playing - 1
+            WHERE project_id = OLD.project_id;
+        END
+    ''',
+}
+
+# Counters recomputed from the base tables (rebuild / drift check)
+STATS_SOURCE_QUERY = '''
+    SELECT
+        p.id AS project_id,
+        COUNT(l.id) AS total,
+        COALESCE(SUM(COALESCE(l.is_active, 0) != 0), 0) AS active,
+        COALESCE(SUM(l.id IS NOT NULL AND COALESCE(l.is_active, 0) = 0), 0) AS disabled,
+        COALESCE(SUM(
+            l.auth_type IN ('count', 'count_date') AND COALESCE(l.remaining_plays, 0) <= 0
+        ), 0) AS count_exhausted,
+        (
+            SELECT COUNT(*) FROM play_sessions s
+            WHERE s.project_id = p.id AND s.status = 'playing'
+        ) AS playing
+    FROM projects p
+    LEFT JOIN licenses l ON l.project_id = p.id
+    GROUP BY p.id
+'''
+
+
+def create_project_stats(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'project_stats'")
+    existed = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS project_stats (
+            project_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 0,
+            disabled INTEGER NOT NULL DEFAULT 0,
+            count_exhausted INTEGER NOT NULL DEFAULT 0,
+            playing INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (project_id) REFERENCES projects (id) ON DELETE CASCADE
+        )
+    ''')
+    for name, body in STATS_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+    if not existed:
+        rebuild_project_stats(cursor)
+
+
+def rebuild_project_stats(cursor):
+    cursor.execute("DELETE FROM project_stats")
+    cursor.execute(
+        f"INSERT INTO project_stats (project_id, {', '.join(STATS_COLUMNS)}) "
+        f"SELECT project_id, {', '.join(STATS_COLUMNS)} FROM ({STATS_SOURCE_QUERY})"
+    )
+
+
+def verify_project_stats(conn):
+    """Return [(project_id, column, stored, actual)] for counters that drifted"""
+    stored = {
+        row["project_id"]: row
+        for row in conn.execute("SELECT * FROM project_stats")
+    }
+    drift = []
+    for actual in conn.execute(STATS_SOURCE_QUERY):
+        row = stored.get(actual["project_id"])
+        for column in STATS_COLUMNS:
+            value = row[column] if row else None
+            if value != actual[column]:
+                drift.append((actual["project_id"], column, value, actual[column]))
+    return drift
+
+
+# Usage rollups: closed play sessions aggregated per license and per project at
+# hourly, daily and monthly grain, bucketed by the session's start time. A
+# trigger adds each session once, when it leaves 'playing' (end_play, timeout,
+# reaper). Rows are history: deleting or archiving sessions does not touch them.
+ROLLUP_GRAINS = {
+    "hour": "%Y-%m-%dT%H",
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+}
+
+ROLLUP_COLUMNS = '''
+    sessions INTEGER NOT NULL DEFAULT 0,
+    timeouts INTEGER NOT NULL DEFAULT 0,
+    duration_seconds INTEGER NOT NULL DEFAULT 0
+'''
+
+
+def rollup_upserts(source):
+    """Upserts adding one closed session (`source` row alias) to every rollup"""
+    statements = []
+    for grain, fmt in ROLLUP_GRAINS.items():
+        bucket = f"strftime('{fmt}', {source}.started_at)"
+        counts = (
+            f"1, {source}.status = 'timeout', COALESCE({source}.duration_seconds, 0)"
+        )
+        statements.append(f'''
+            INSERT INTO license_usage_rollups (
+                grain, bucket, license_id, project_id, sessions, timeouts, duration_seconds
+            ) VALUES (
+                '{grain}', {bucket}, {source}.license_id, {source}.project_id, {counts}
+            )
+            ON CONFLICT(grain, license_id, bucket) DO UPDATE SET
+                sessions = sessions + excluded.sessions,
+                timeouts = timeouts + excluded.timeouts,
+                duration_seconds = duration_seconds + excluded.duration_seconds;
+            INSERT INTO project_usage_rollups (
+                grain, bucket, project_id, sessions, timeouts, duration_seconds
+            ) VALUES ('{grain}', {bucket}, {source}.project_id, {counts})
+            ON CONFLICT(grain, project_id, bucket) DO UPDATE SET
+                sessions = sessions + excluded.sessions,
+                timeouts = timeouts + excluded.timeouts,
+                duration_seconds = duration_seconds + excluded.duration_seconds;
+        ''')
+    return "".join(statements)
+
+
+def create_usage_rollups(cursor):
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'license_usage_rollups'"
+    )
+    existed = cursor.fetchone() is not None
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS license_usage_rollups (
+            grain TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            license_id INTEGER NOT NULL,
+            project_id INTEGER NOT NULL,
+            {ROLLUP_COLUMNS},
+            PRIMARY KEY (grain, license_id, bucket)
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS project_usage_rollups (
+            grain TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            project_id INTEGER NOT NULL,
+            {ROLLUP_COLUMNS},
+            PRIMARY KEY (grain, project_id, bucket)
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_play_sessions_rollup
+        AFTER UPDATE OF status ON play_sessions
+        WHEN OLD.status = 'playing' AND NEW.status != 'playing' AND NEW.started_at IS NOT NULL
+        BEGIN
+            {rollup_upserts("NEW")}
+        END
+    ''')
+    if not existed:
+        rebuild_usage_rollups(cursor)
+
+
+def table_columns(cursor, table, schema="main"):
+    rows = cursor.execute(f"PRAGMA {schema}.table_info({table})").fetchall()
+    return [(row[1], row[2]) for row in rows]
+
+
+def create_session_archive(cursor):
+    """Create or extend archive.play_sessions to mirror the hot table's columns.
 
-    # Create Projects table
+    Archived rows keep their ids. There are no foreign keys across databases;
+    license and project deletes remove archived sessions explicitly.
+    """
+    columns = table_columns(cursor, "play_sessions")
+    archived = {name for name, _type in table_columns(cursor, "play_sessions", "archive")}
+    if not archived:
+        definitions = ", ".join(
+            "id INTEGER PRIMARY KEY" if name == "id" else f"{name} {column_type}"
+            for name, column_type in columns
+        )
+        cursor.execute(f"CREATE TABLE archive.play_sessions ({definitions})")
+    else:
+        for name, column_type in columns:
+            if name not in archived:
+                cursor.execute(
+                    f"ALTER TABLE archive.play_sessions ADD COLUMN {name} {column_type}"
+                )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS archive.idx_archived_sessions_license "
+        "ON play_sessions(license_id, started_at, id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS archive.idx_archived_sessions_started "
+        "ON play_sessions(started_at)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS archive.idx_archived_sessions_project "
+        "ON play_sessions(project_id)"
+    )
+
+
+def play_session_columns(cursor):
+    return [name for name, _type in table_columns(cursor, "play_sessions")]
+
+
+def all_play_sessions(cursor, where=""):
+    """Compound SELECT over hot and archived sessions; `where` applies to both
+    sides, so its parameters must be passed twice.
+
+    UNION rather than UNION ALL: a crash between the archive and hot commits of
+    an archival chunk can leave a row in both until the next run removes it.
+    """
+    columns = ", ".join(play_session_columns(cursor))
+    return (
+        f"SELECT {columns} FROM main.play_sessions {where} "
+        f"UNION SELECT {columns} FROM archive.play_sessions {where}"
+    )
+
+
+def rebuild_usage_rollups(cursor):
+    """Recompute all rollups from closed sessions, hot and archived"""
+    cursor.execute("DELETE FROM license_usage_rollups")
+    cursor.execute("DELETE FROM project_usage_rollups")
+    counts = """
+        COUNT(*), COALESCE(SUM(status = 'timeout'), 0), COALESCE(SUM(duration_seconds), 0)
+    """
+    source = "main.play_sessions"
+    # The archive is mirrored after the main schema migrations, so it does not
+    # exist yet when the rollups are first built.
+    if table_columns(cursor, "play_sessions", "archive"):
+        source = f"({all_play_sessions(cursor)})"
+    closed = f"FROM {source} WHERE status != 'playing' AND started_at IS NOT NULL"
+    for grain, fmt in ROLLUP_GRAINS.items():
+        bucket = f"strftime('{fmt}', started_at)"
+        cursor.execute(f'''
+            INSERT INTO license_usage_rollups (
+                grain, bucket, license_id, project_id, sessions, timeouts, duration_seconds
+            )
+            SELECT '{grain}', {bucket} AS b, license_id, MAX(project_id), {counts}
+            {closed}
+            GROUP BY license_id, b
+        ''')
+        cursor.execute(f'''
+            INSERT INTO project_usage_rollups (
+                grain, bucket, project_id, sessions, timeouts, duration_seconds
+            )
+            SELECT '{grain}', {bucket} AS b, project_id, {counts}
+            {closed}
+            GROUP BY project_id, b
+        ''')
+
+
+# --- Epoch timestamp columns ---
+# The ISO strings remain the stored and API format; each *_ts column holds the
+# same instant as Unix seconds for comparisons, ranges and arithmetic. Naive
+# strings are local time (datetime.now().isoformat()), and a date-only
+# valid_until lasts until the end of that day. Hot paths write both columns;
+# triggers fill in the epoch for every other writer.
+EPOCH_COLUMNS = (
+    # (table, column, end_of_day)
+    ("licenses", "valid_until", True),
+    ("licenses", "created_at", False),
+    ("play_sessions", "started_at", False),
+    ("play_sessions", "last_heartbeat_at", False),
+    ("play_sessions", "ended_at", False),
+)
+
+
+def epoch_sql(value, end_of_day=False):
+    """SQL expression for the Unix seconds of an ISO string expression"""
+    epoch = f"CAST(strftime('%s', {value}, 'utc') AS INTEGER)"
+    if not end_of_day:
+        return epoch
+    return (
+        f"CASE WHEN length({value}) = 10 "
+        f"THEN CAST(strftime('%s', {value}, '+1 day', 'utc') AS INTEGER) - 1 "
+        f"ELSE {epoch} END"
+    )
+
+
+def iso_to_epoch(value, end_of_day=False):
+    """Python counterpart of epoch_sql; None for empty or unparseable values"""
+    if not value:
+        return None
+    try:
+        if end_of_day and len(value) == 10:
+            moment = datetime.datetime.combine(
+                datetime.date.fromisoformat(value), datetime.time.max
+            )
+        else:
+            moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return int(moment.timestamp())
+
+
+def create_epoch_columns(cursor, schema="main"):
+    """Add and backfill the *_ts columns; triggers keep them current in main."""
+    for table in ("licenses", "play_sessions"):
+        if not table_columns(cursor, table, schema):
+            continue
+        existing = {name for name, _type in table_columns(cursor, table, schema)}
+        assignments = []
+        for epoch_table, column, end_of_day in EPOCH_COLUMNS:
+            if epoch_table != table:
+                continue
+            if f"{column}_ts" not in existing:
+                cursor.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column}_ts INTEGER")
+            assignments.append(f"{column}_ts = {epoch_sql(column, end_of_day)}")
+        cursor.execute(f"UPDATE {schema}.{table} SET {', '.join(assignments)}")
+
+    if schema != "main":
+        return
+    for table, column, end_of_day in EPOCH_COLUMNS:
+        epoch = epoch_sql(f"NEW.{column}", end_of_day)
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{column}_ts_insert
+            AFTER INSERT ON {table}
+            WHEN NEW.{column} IS NOT NULL AND NEW.{column}_ts IS NULL
+            BEGIN
+                UPDATE {table} SET {column}_ts = {epoch} WHERE id = NEW.id;
+            END
+        ''')
+        # Writers that set the epoch themselves change it along with the string.
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{column}_ts_update
+            AFTER UPDATE OF {column} ON {table}
+            WHEN NEW.{column} IS NOT OLD.{column} AND NEW.{column}_ts IS OLD.{column}_ts
+            BEGIN
+                UPDATE {table} SET {column}_ts = {epoch} WHERE id = NEW.id;
+            END
+        ''')
+
+
+# --- Schema migrations ---
+# The schema version lives in PRAGMA user_version. Migrations run in order,
+# all pending ones inside a single BEGIN IMMEDIATE transaction, so concurrent
+# processes wait for the first one and then find the database current. Steps
+# are idempotent because databases created before the registry existed start
+# at version 0 with any subset of them already applied.
+
+
+def migration_base_schema(c):
+    """Projects, licenses, play sessions and admin users, incl. legacy upgrades"""
     c.execute('''
         CREATE TABLE IF NOT EXISTS projects (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -43,16 +880,10 @@ def init_db():
             project_type TEXT DEFAULT 'activation'
         )
     ''')
-
-    try:
-        ensure_column(c, 'projects', 'project_type', "TEXT DEFAULT 'activation'")
-        c.execute(
-            "UPDATE projects SET project_type = 'activation' WHERE project_type IS NULL OR project_type = ''"
-        )
-        conn.commit()
-    except Exception as e:
-        print(f"添加项目类型字段时出错: {e}")
-        conn.rollback()
+    ensure_column(c, 'projects', 'project_type', "TEXT DEFAULT 'activation'")
+    c.execute(
+        "UPDATE projects SET project_type = 'activation' WHERE project_type IS NULL OR project_type = ''"
+    )
 
     # Create Licenses table (replaces keys table)
     c.execute('''
@@ -77,70 +908,56 @@ def init_db():
     # Create indexes for licenses table
     c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_project_id ON licenses(project_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_license_key ON licenses(license_key)')
-    
+
     # Migrate licenses table if it has old columns (subject_type, subject_value, expires_at, meta)
-    try:
-        # Check if licenses table exists and has old columns
-        c.execute("PRAGMA table_info(licenses)")
-        columns = [row[1] for row in c.fetchall()]
-        old_columns = ['subject_type', 'subject_value', 'expires_at', 'meta']
-        has_old_columns = any(col in columns for col in old_columns)
-        
-        if has_old_columns:
-            print("检测到旧表结构，开始迁移数据...")
-            # Create temporary table with new structure
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS licenses_new (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    project_id INTEGER NOT NULL,
-                    license_key TEXT NOT NULL,
-                    is_active INTEGER DEFAULT 1,
-                    remarks TEXT,
-                    created_at TEXT NOT NULL,
-                    FOREIGN KEY (project_id) REFERENCES projects (id) ON DELETE CASCADE,
-                    UNIQUE(project_id, license_key)
-                )
-            ''')
-            
-            # Copy data from old table to new table
-            c.execute('''
-                INSERT INTO licenses_new (
-                    id, project_id, license_key, is_active, remarks, created_at
-                )
-                SELECT 
-                    id, project_id, license_key, is_active, remarks, created_at
-                FROM licenses
-            ''')
-            
-            # Drop old table and indexes
-            c.execute('DROP INDEX IF EXISTS idx_licenses_subject')
-            c.execute('DROP TABLE licenses')
-            
-            # Rename new table
-            c.execute('ALTER TABLE licenses_new RENAME TO licenses')
-            
-            # Recreate indexes
-            c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_project_id ON licenses(project_id)')
-            c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_license_key ON licenses(license_key)')
-            
-            conn.commit()
-            print("数据迁移完成：已删除 subject_type, subject_value, expires_at, meta 字段")
-    except Exception as e:
-        print(f"迁移表结构时出错: {e}")
-        conn.rollback()
+    c.execute("PRAGMA table_info(licenses)")
+    columns = [row[1] for row in c.fetchall()]
+    old_columns = ['subject_type', 'subject_value', 'expires_at', 'meta']
+    if any(col in columns for col in old_columns):
+        print("检测到旧表结构，开始迁移数据...")
+        # Create temporary table with new structure
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS licenses_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                project_id INTEGER NOT NULL,
+                license_key TEXT NOT NULL,
+                is_active INTEGER DEFAULT 1,
+                remarks TEXT,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY (project_id) REFERENCES projects (id) ON DELETE CASCADE,
+                UNIQUE(project_id, license_key)
+            )
+        ''')
+
+        # Copy data from old table to new table
+        c.execute('''
+            INSERT INTO licenses_new (
+                id, project_id, license_key, is_active, remarks, created_at
+            )
+            SELECT
+                id, project_id, license_key, is_active, remarks, created_at
+            FROM licenses
+        ''')
+
+        # Drop old table and indexes
+        c.execute('DROP INDEX IF EXISTS idx_licenses_subject')
+        c.execute('DROP TABLE licenses')
+
+        # Rename new table
+        c.execute('ALTER TABLE licenses_new RENAME TO licenses')
+
+        # Recreate indexes
+        c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_project_id ON licenses(project_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_license_key ON licenses(license_key)')
+        print("数据迁移完成：已删除 subject_type, subject_value, expires_at, meta 字段")
 
     # Add forward-compatible authorization columns if they do not exist.
-    try:
-        ensure_column(c, 'licenses', 'last_registered_at', 'TEXT')
-        ensure_column(c, 'licenses', 'auth_type', "TEXT DEFAULT 'unlimited'")
-        ensure_column(c, 'licenses', 'remaining_plays', 'INTEGER')
-        ensure_column(c, 'licenses', 'valid_until', 'TEXT')
-        ensure_column(c, 'licenses', 'machine_code', 'TEXT')
-        ensure_column(c, 'licenses', 'last_play_started_at', 'TEXT')
-        conn.commit()
-    except Exception as e:
-        print(f"添加授权字段时出错: {e}")
-        conn.rollback()
+    ensure_column(c, 'licenses', 'last_registered_at', 'TEXT')
+    ensure_column(c, 'licenses', 'auth_type', "TEXT DEFAULT 'unlimited'")
+    ensure_column(c, 'licenses', 'remaining_plays', 'INTEGER')
+    ensure_column(c, 'licenses', 'valid_until', 'TEXT')
+    ensure_column(c, 'licenses', 'machine_code', 'TEXT')
+    ensure_column(c, 'licenses', 'last_play_started_at', 'TEXT')
 
     # Create play session logs for VR/client playback billing.
     c.execute('''
@@ -166,7 +983,7 @@ def init_db():
     c.execute('CREATE INDEX IF NOT EXISTS idx_play_sessions_license_id ON play_sessions(license_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_play_sessions_session_id ON play_sessions(session_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_play_sessions_status ON play_sessions(status)')
-    
+
     # Create AdminUsers table
     c.execute('''
         CREATE TABLE IF NOT EXISTS admin_users (
@@ -176,62 +993,303 @@ def init_db():
             created_at TEXT NOT NULL
         )
     ''')
-    
+
     # Migrate data from old keys table to licenses table (if keys table exists)
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='keys'")
-        if c.fetchone():
-            # Check if licenses table is empty (migration not done yet)
-            c.execute("SELECT COUNT(*) FROM licenses")
-            if c.fetchone()[0] == 0:
-                # Migrate data from keys to licenses
-                c.execute('''
-                    INSERT INTO licenses (
-                        project_id, 
-                        license_key, 
-                        is_active, 
-                        remarks, 
-                        created_at
-                    )
-                    SELECT 
-                        project_id,
-                        key as license_key,
-                        is_active,
-                        remarks,
-                        created_at
-                    FROM keys
-                ''')
-                print("数据已从 keys 表迁移到 licenses 表")
-    except Exception as e:
-        print(f"迁移数据时出错（可能 keys 表不存在）: {e}")
-    
-    # Create default project if not exists
-    try:
-        c.execute('SELECT id FROM projects WHERE is_default = 1')
-        if not c.fetchone():
-            now = datetime.datetime.now().isoformat()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='keys'")
+    if c.fetchone():
+        # Check if licenses table is empty (migration not done yet)
+        c.execute("SELECT COUNT(*) FROM licenses")
+        if c.fetchone()[0] == 0:
             c.execute('''
-                INSERT INTO projects (
-                    name, description, created_at, is_default, project_type
-                ) VALUES (?, ?, ?, ?, ?)
-            ''', ('Default Project', 'System default project', now, 1, 'activation'))
-    except sqlite3.IntegrityError:
-        pass # Already exists
-    
-    # Create default admin user if not exists
+                INSERT INTO licenses (
+                    project_id,
+                    license_key,
+                    is_active,
+                    remarks,
+                    created_at
+                )
+                SELECT
+                    project_id,
+                    key as license_key,
+                    is_active,
+                    remarks,
+                    created_at
+                FROM keys
+            ''')
+            print("数据已从 keys 表迁移到 licenses 表")
+
+
+def migration_default_rows(c):
+    """Default project and admin user"""
+    now = datetime.datetime.now().isoformat()
+    c.execute('SELECT id FROM projects WHERE is_default = 1')
+    if not c.fetchone():
+        c.execute('''
+            INSERT OR IGNORE INTO projects (
+                name, description, created_at, is_default, project_type
+            ) VALUES (?, ?, ?, ?, ?)
+        ''', ('Default Project', 'System default project', now, 1, 'activation'))
+
+    # Store password in plain text
+    c.execute(
+        'INSERT OR IGNORE INTO admin_users (username, password, created_at) VALUES (?, ?, ?)',
+        ('admin', 'admin123', now),
+    )
+
+
+def migration_client_lookup_indexes(c):
+    """Indexes for client lookups and keyset pagination of the license list"""
+    # Client lookups probe (project_id, license_key) through the UNIQUE constraint
+    # and, for playback projects, (project_id, machine_code).
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS idx_licenses_project_machine '
+        'ON licenses(project_id, machine_code)'
+    )
+    # Keyset pagination of the admin license list (newest first)
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS idx_licenses_project_created '
+        'ON licenses(project_id, created_at, id)'
+    )
+    c.execute('CREATE INDEX IF NOT EXISTS idx_licenses_created ON licenses(created_at, id)')
+
+
+def migration_session_timeouts(c):
+    """Heartbeat-based session timeouts and time-range session exports"""
+    # Per project, see maintenance.py
+    ensure_column(c, 'projects', 'play_session_timeout_minutes', 'INTEGER')
+    c.execute(
+        "UPDATE play_sessions SET last_heartbeat_at = started_at "
+        "WHERE status = 'playing' AND last_heartbeat_at IS NULL"
+    )
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_play_sessions_playing
+        ON play_sessions(project_id, last_heartbeat_at)
+        WHERE status = 'playing'
+    ''')
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS idx_play_sessions_started ON play_sessions(started_at)'
+    )
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS idx_play_sessions_project_started '
+        'ON play_sessions(project_id, started_at)'
+    )
+
+
+def migration_project_stats(c):
+    """Trigger-maintained project counters"""
+    # Expired-license counts per project
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS idx_licenses_project_valid_until '
+        'ON licenses(project_id, valid_until)'
+    )
+    create_project_stats(c)
+
+
+def migration_session_archive(c):
+    """Hot/cold archival of closed play sessions"""
+    # Closed sessions are archived by ended_at (see maintenance.archive_closed_sessions)
+    c.execute(
+        "UPDATE play_sessions SET ended_at = COALESCE(last_heartbeat_at, started_at) "
+        "WHERE status != 'playing' AND ended_at IS NULL"
+    )
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_play_sessions_closed_ended
+        ON play_sessions(ended_at)
+        WHERE status != 'playing'
+    ''')
+    # Keyset paging of a license's history (hot and archived)
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS idx_play_sessions_license_started '
+        'ON play_sessions(license_id, started_at, id)'
+    )
+
+
+def migration_epoch_columns(c):
+    """Integer epoch columns next to the ISO timestamps"""
+    create_epoch_columns(c)
+    # The epoch indexes replace their string counterparts.
+    c.execute(
+        'CREATE INDEX IF NOT EXISTS idx_licenses_project_valid_until_ts '
+        'ON licenses(project_id, valid_until_ts)'
+    )
+    c.execute('DROP INDEX IF EXISTS idx_licenses_project_valid_until')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_play_sessions_playing_ts
+        ON play_sessions(project_id, last_heartbeat_at_ts)
+        WHERE status = 'playing'
+    ''')
+    c.execute('DROP INDEX IF EXISTS idx_play_sessions_playing')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_play_sessions_closed_ended_ts
+        ON play_sessions(ended_at_ts)
+        WHERE status != 'playing'
+    ''')
+    c.execute('DROP INDEX IF EXISTS idx_play_sessions_closed_ended')
+    # Archived rows need the columns (and values) before the next archival run.
+    if table_columns(c, "play_sessions", "archive"):
+        create_session_archive(c)
+        create_epoch_columns(c, "archive")
+
+
+def migration_license_watch_indexes(c):
+    """Indexes for the expiring-soon and low-plays watch lists"""
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_licenses_expiring
+        ON licenses(valid_until_ts, id)
+        WHERE valid_until_ts IS NOT NULL
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_licenses_low_plays
+        ON licenses(remaining_plays, id)
+        WHERE auth_type IN ('count', 'count_date')
+    ''')
+
+
+def migration_stats_triggers(c):
+    """Recreate the project stats triggers without INSERT OR IGNORE"""
+    for name, body in STATS_TRIGGERS.items():
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"CREATE TRIGGER {name} {body}")
+
+
+# (version, description, step). Append only; never renumber or edit a released step.
+MIGRATIONS = [
+    (1, "基础表结构", migration_base_schema),
+    (2, "默认项目与管理员", migration_default_rows),
+    (3, "客户端查询与分页索引", migration_client_lookup_indexes),
+    (4, "播放会话超时", migration_session_timeouts),
+    (5, "项目统计计数", migration_project_stats),
+    (6, "用量汇总", create_usage_rollups),
+    (7, "播放记录归档", migration_session_archive),
+    (8, "整数时间戳列", migration_epoch_columns),
+    (9, "到期与低次数查询索引", migration_license_watch_indexes),
+    (10, "修复统计触发器", migration_stats_triggers),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_versions(conn):
+    main = conn.execute("PRAGMA main.user_version").fetchone()[0]
+    archive = conn.execute("PRAGMA archive.user_version").fetchone()[0]
+    return main, archive
+
+
+def migrate(conn):
+    """Apply pending migrations; returns the versions applied (empty if current).
+
+    archive.play_sessions mirrors the hot table's columns, so it is brought up
+    to date (and stamped with the same version) whenever the main schema
+    changes or the archive file is new.
+    """
+    if schema_versions(conn) == (SCHEMA_VERSION, SCHEMA_VERSION):
+        return []
+
+    begin_immediate(conn)
     try:
-        c.execute('SELECT id FROM admin_users WHERE username = ?', ('admin',))
-        if not c.fetchone():
-            now = datetime.datetime.now().isoformat()
-            # Store password in plain text
-            c.execute('INSERT INTO admin_users (username, password, created_at) VALUES (?, ?, ?)',
-                      ('admin', 'admin123', now))
-    except sqlite3.IntegrityError:
-        pass # Already exists
-
-    conn.commit()
-    conn.close()
+        # Another process may have migrated while this one waited for the lock.
+        version, archive_version = schema_versions(conn)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"数据库版本 {version} 高于程序支持的版本 {SCHEMA_VERSION}")
+        c = conn.cursor()
+        applied = []
+        for number, description, step in MIGRATIONS:
+            if number > version:
+                step(c)
+                applied.append(number)
+                print(f"已应用迁移 {number}: {description}")
+        c.execute(f"PRAGMA main.user_version = {SCHEMA_VERSION}")
+        if archive_version != SCHEMA_VERSION:
+            create_session_archive(c)
+            c.execute(f"PRAGMA archive.user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+
+def init_db():
+    conn = get_db_connection()
+    try:
+        apply_journal_mode(conn)
+        migrate(conn)
+    finally:
+        conn.close()
+
 
 if __name__ == '__main__':
-    init_db()
-    print("Database initialized.")
+    import argparse
+
+    parser = argparse.ArgumentParser(description="KeyHub 数据库工具")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("init", help="创建/升级数据库结构（默认，同 migrate）")
+    migrate_parser = commands.add_parser("migrate", help="应用待执行的数据库迁移")
+    migrate_parser.add_argument("--status", action="store_true", help="仅显示当前版本")
+    import_parser = commands.add_parser("import", help="从 CSV/JSONL 导入授权")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--project-id", type=int, required=True)
+    import_parser.add_argument("--format", choices=["csv", "jsonl", "ndjson"])
+    import_parser.add_argument("--dry-run", action="store_true")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    stats_parser = commands.add_parser("stats", help="校验/重建项目统计计数")
+    stats_parser.add_argument("--rebuild", action="store_true")
+    commands.add_parser("rollups", help="从播放记录重建用量汇总")
+    archive_parser = commands.add_parser("archive", help="归档已结束的播放记录")
+    archive_parser.add_argument("--older-than-days", type=int)
+    archive_parser.add_argument("--batch-size", type=int)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        from license_import import run_cli
+        run_cli(args)
+    elif args.command == "stats":
+        conn = get_db_connection()
+        drift = verify_project_stats(conn)
+        for project_id, column, stored, actual in drift:
+            print(f"项目 {project_id} 的 {column}: 记录 {stored}，实际 {actual}")
+        if drift and args.rebuild:
+            rebuild_project_stats(conn)
+            conn.commit()
+            print("统计计数已重建")
+        elif not drift:
+            print("统计计数一致")
+        conn.close()
+    elif args.command == "rollups":
+        conn = get_db_connection()
+        begin_immediate(conn)
+        rebuild_usage_rollups(conn)
+        conn.commit()
+        conn.close()
+        print("用量汇总已重建")
+    elif args.command == "archive":
+        import maintenance
+        conn = get_db_connection()
+        moved = maintenance.archive_closed_sessions(
+            conn,
+            older_than_days=(
+                maintenance.ARCHIVE_AFTER_DAYS
+                if args.older_than_days is None
+                else args.older_than_days
+            ),
+            batch_size=args.batch_size or maintenance.ARCHIVE_BATCH_SIZE,
+        )
+        conn.close()
+        print(f"已归档 {moved} 条播放记录")
+    elif args.command == "migrate" and args.status:
+        conn = get_db_connection()
+        version, archive_version = schema_versions(conn)
+        conn.close()
+        print(f"数据库版本 {version}，归档库版本 {archive_version}，最新版本 {SCHEMA_VERSION}")
+        for number, description, _step in MIGRATIONS:
+            print(f"  {number:3} {'已应用' if number <= version else '待执行'}  {description}")
+    else:
+        conn = get_db_connection()
+        try:
+            apply_journal_mode(conn)
+            applied = migrate(conn)
+        finally:
+            conn.close()
+        if applied:
+            print(f"数据库已升级到版本 {SCHEMA_VERSION}")
+        else:
+            print(f"数据库已是最新版本 {SCHEMA_VERSION}")
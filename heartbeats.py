@@ -0,0 +1,190 @@
+import atexit
+import collections
+import os
+import threading
+import time
+
+from database import db_pool, iso_to_epoch
+from metrics import metrics
+
+# Flush buffered heartbeats every N seconds or as soon as M sessions are pending.
+HEARTBEAT_FLUSH_SECONDS = float(os.environ.get("KEYHUB_HEARTBEAT_FLUSH_SECONDS", "5"))
+HEARTBEAT_FLUSH_MAX = int(os.environ.get("KEYHUB_HEARTBEAT_FLUSH_MAX", "500"))
+# How long a session confirmed as 'playing' is trusted before it is re-read from
+# the database (another worker process may have ended it).
+HEARTBEAT_SESSION_TTL = float(os.environ.get("KEYHUB_HEARTBEAT_SESSION_TTL", "30"))
+
+
+class HeartbeatBuffer:
+    """Coalesces play session heartbeats into periodic batch updates.
+
+    Only the latest timestamp per session is kept. A background thread writes the
+    batch to play_sessions in one transaction; the thread is started lazily so a
+    process that forks workers does not carry it into the children.
+    """
+
+    def __init__(
+        self,
+        pool,
+        interval=HEARTBEAT_FLUSH_SECONDS,
+        max_pending=HEARTBEAT_FLUSH_MAX,
+        session_ttl=HEARTBEAT_SESSION_TTL,
+    ):
+        self.pool = pool
+        self.interval = interval
+        self.max_pending = max_pending
+        self.session_ttl = session_ttl
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._playing = collections.OrderedDict()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._counters = {
+            "recorded": 0,
+            "flushes": 0,
+            "flushed_rows": 0,
+            "flush_errors": 0,
+        }
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent keeps (and flushes) its own buffer; the child starts empty.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._playing = collections.OrderedDict()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def is_playing(self, session_id):
+        """True if the session was recently confirmed as playing in this process."""
+        with self._lock:
+            confirmed_at = self._playing.get(session_id)
+            if confirmed_at is None:
+                return False
+            if time.monotonic() - confirmed_at > self.session_ttl:
+                del self._playing[session_id]
+                return False
+            return True
+
+    def mark_playing(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            self._playing[session_id] = now
+            self._playing.move_to_end(session_id)
+            self._prune_playing(now)
+
+    def _prune_playing(self, now):
+        # Kept in confirmation order, so only expired entries at the front are
+        # looked at; sessions never heartbeated or ended here do not pile up.
+        playing = self._playing
+        cutoff = now - self.session_ttl
+        while playing:
+            confirmed_at = next(iter(playing.values()))
+            if confirmed_at >= cutoff:
+                break
+            playing.popitem(last=False)
+
+    def forget(self, session_id):
+        """Drop a session that ended; its buffered heartbeat is superseded."""
+        with self._lock:
+            self._playing.pop(session_id, None)
+            self._pending.pop(session_id, None)
+
+    def record(self, session_id, timestamp):
+        with self._lock:
+            self._pending[session_id] = timestamp
+            self._counters["recorded"] += 1
+            full = len(self._pending) >= self.max_pending
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    def pending_heartbeat(self, session_id):
+        with self._lock:
+            return self._pending.get(session_id)
+
+    def flush(self):
+        """Write all buffered heartbeats in one transaction. Returns rows written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._prune_playing(time.monotonic())
+            if not batch:
+                return 0
+
+            try:
+                with metrics.context("heartbeat_flush"), self.pool.connection() as conn:
+                    conn.executemany(
+                        """
+                        UPDATE play_sessions
+                        SET last_heartbeat_at = ?, last_heartbeat_at_ts = ?
+                        WHERE session_id = ? AND status = 'playing'
+                        """,
+                        [
+                            (timestamp, iso_to_epoch(timestamp), session_id)
+                            for session_id, timestamp in batch.items()
+                        ],
+                    )
+                    conn.commit()
+            except Exception:
+                # Put the batch back unless a newer heartbeat arrived meanwhile.
+                with self._lock:
+                    for session_id, timestamp in batch.items():
+                        self._pending.setdefault(session_id, timestamp)
+                    self._counters["flush_errors"] += 1
+                raise
+
+            with self._lock:
+                self._counters["flushes"] += 1
+                self._counters["flushed_rows"] += len(batch)
+            return len(batch)
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="keyhub-heartbeat-flusher", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as exc:
+                print(f"写入心跳失败: {exc}")
+
+    def stop(self, timeout=None):
+        """Stop the flusher thread and write whatever is still buffered."""
+        self._stopping.set()
+        self._wake.set()
+        thread = self._thread
+        if thread and thread.is_alive() and self._pid == os.getpid():
+            thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "pending": len(self._pending),
+                "playing_cached": len(self._playing),
+            }
+
+
+heartbeat_buffer = HeartbeatBuffer(db_pool)
+atexit.register(heartbeat_buffer.stop)
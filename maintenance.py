@@ -0,0 +1,205 @@
+import datetime
+import os
+import threading
+import time
+
+from database import begin_immediate, db_pool, play_session_columns
+from heartbeats import heartbeat_buffer
+from metrics import metrics
+
+# Default time without heartbeat after which a playing session is timed out.
+# Projects can override it with projects.play_session_timeout_minutes.
+PLAY_SESSION_TIMEOUT_MINUTES = int(
+    os.environ.get("KEYHUB_PLAY_SESSION_TIMEOUT_MINUTES", str(8 * 60))
+)
+REAPER_INTERVAL_SECONDS = float(os.environ.get("KEYHUB_REAPER_INTERVAL_SECONDS", "60"))
+
+# Closed sessions that ended more than N days ago move to the archive database
+# (0 disables archival), in chunks of KEYHUB_ARCHIVE_BATCH_SIZE rows per transaction.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("KEYHUB_ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("KEYHUB_ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get("KEYHUB_ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+
+def reap_stale_play_sessions(conn, now=None):
+    """Time out playing sessions whose last heartbeat is older than the project timeout.
+
+    Runs in its own write transaction and returns the reaped session ids.
+    """
+    now = now or datetime.datetime.now()
+    begin_immediate(conn)
+    try:
+        # Served by the partial index on playing sessions.
+        projects = conn.execute(
+            """
+            SELECT p.id, p.play_session_timeout_minutes
+            FROM projects p
+            WHERE p.id IN (
+                SELECT DISTINCT project_id FROM play_sessions WHERE status = 'playing'
+            )
+            """
+        ).fetchall()
+
+        reaped = []
+        for project in projects:
+            minutes = project["play_session_timeout_minutes"] or PLAY_SESSION_TIMEOUT_MINUTES
+            cutoff = int((now - datetime.timedelta(minutes=minutes)).timestamp())
+            params = (project["id"], cutoff)
+            reaped.extend(
+                row["session_id"]
+                for row in conn.execute(
+                    """
+                    SELECT session_id FROM play_sessions
+                    WHERE project_id = ? AND status = 'playing' AND last_heartbeat_at_ts < ?
+                    """,
+                    params,
+                )
+            )
+            conn.execute(
+                """
+                UPDATE play_sessions
+                SET status = 'timeout',
+                    ended_at = COALESCE(ended_at, last_heartbeat_at, started_at),
+                    ended_at_ts = COALESCE(ended_at_ts, last_heartbeat_at_ts, started_at_ts),
+                    duration_seconds = last_heartbeat_at_ts - started_at_ts
+                WHERE project_id = ? AND status = 'playing' AND last_heartbeat_at_ts < ?
+                """,
+                params,
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return reaped
+
+
+def run_session_reaper():
+    # Buffered heartbeats must reach the table before sessions are judged stale.
+    heartbeat_buffer.flush()
+    with db_pool.connection() as conn:
+        reaped = reap_stale_play_sessions(conn)
+    for session_id in reaped:
+        heartbeat_buffer.forget(session_id)
+    return len(reaped)
+
+
+def archive_closed_sessions(
+    conn,
+    older_than_days=ARCHIVE_AFTER_DAYS,
+    batch_size=ARCHIVE_BATCH_SIZE,
+    now=None,
+):
+    """Move closed sessions that ended before the cutoff into archive.play_sessions.
+
+    Each chunk is copied and deleted in one short write transaction so request
+    writers are never blocked for long. Returns the number of rows moved.
+    """
+    now = now or datetime.datetime.now()
+    cutoff = int((now - datetime.timedelta(days=older_than_days)).timestamp())
+    columns = ", ".join(play_session_columns(conn))
+    moved = 0
+    while True:
+        begin_immediate(conn)
+        try:
+            # Served by the partial index on closed sessions.
+            ids = [
+                row["id"]
+                for row in conn.execute(
+                    """
+                    SELECT id FROM main.play_sessions
+                    WHERE status != 'playing' AND ended_at_ts < ?
+                    ORDER BY ended_at_ts
+                    LIMIT ?
+                    """,
+                    (cutoff, batch_size),
+                )
+            ]
+            if not ids:
+                conn.commit()
+                return moved
+            placeholders = ", ".join("?" * len(ids))
+            # With WAL the two files commit separately; OR IGNORE lets a chunk that
+            # was copied but not deleted be retried.
+            conn.execute(
+                f"""
+                INSERT OR IGNORE INTO archive.play_sessions ({columns})
+                SELECT {columns} FROM main.play_sessions WHERE id IN ({placeholders})
+                """,
+                ids,
+            )
+            conn.execute(f"DELETE FROM main.play_sessions WHERE id IN ({placeholders})", ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        moved += len(ids)
+
+
+def run_session_archiver():
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    with db_pool.connection() as conn:
+        return archive_closed_sessions(conn)
+
+
+class MaintenanceThread:
+    """Runs periodic database jobs off the request path.
+
+    Jobs are (name, interval_seconds, callable) entries. The thread belongs to the
+    process that started it; forked workers do not inherit it.
+    """
+
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.jobs = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._last_run = {}
+        self.last_results = {}
+
+    def add_job(self, name, interval, func):
+        self.jobs.append((name, interval, func))
+
+    def start(self):
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="keyhub-maintenance", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def run_pending(self):
+        now = time.monotonic()
+        for name, interval, func in self.jobs:
+            last = self._last_run.get(name)
+            if last is not None and now - last < interval:
+                continue
+            self._last_run[name] = now
+            started = time.perf_counter()
+            try:
+                with metrics.context(name):
+                    self.last_results[name] = func()
+            except Exception as exc:
+                metrics.inc("keyhub_job_failures_total", (("job", name),))
+                print(f"后台任务 {name} 执行失败: {exc}")
+            metrics.observe(
+                "keyhub_job_duration_seconds", (("job", name),), time.perf_counter() - started
+            )
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_pending()
+            self._stop.wait(self.tick)
+
+
+maintenance = MaintenanceThread()
+maintenance.add_job("session_reaper", REAPER_INTERVAL_SECONDS, run_session_reaper)
+maintenance.add_job("session_archiver", ARCHIVE_INTERVAL_SECONDS, run_session_archiver)
@@ -0,0 +1,263 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# With several worker processes (serve.py) each worker writes its snapshot to
+# this directory and /metrics sums them; unset means a single process.
+METRICS_DIR = os.environ.get("KEYHUB_METRICS_DIR") or None
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Shard:
+    """Counters and histograms written by a single thread."""
+
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+
+
+def merge_into(counters, histograms, source_counters, source_histograms):
+    for key, value in source_counters:
+        counters[key] = counters.get(key, 0) + value
+    for key, entry in source_histograms:
+        target = histograms.get(key)
+        if target is None:
+            histograms[key] = list(entry)
+        else:
+            for index, value in enumerate(entry):
+                target[index] += value
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metrics:
+    """Request, database and job metrics with per-thread aggregation.
+
+    Every thread records into its own shard, so the request path takes no lock;
+    a scrape sums the shards. Shards of threads that have exited are folded into
+    a retired total. Counter names ending in _total are counters, other counter
+    names are gauges (e.g. in-flight requests, +1 on start and -1 on finish).
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, directory=METRICS_DIR):
+        self.buckets = tuple(buckets)
+        self.directory = directory
+        self._collectors = []
+        self._reset_state()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_state)
+
+    def _reset_state(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = Shard()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = Shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        entry = histograms.get(key)
+        if entry is None:
+            entry = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    # --- Request and database timing ---
+
+    def context_labels(self):
+        return (("context", getattr(self._local, "context", None) or "background"),)
+
+    @contextlib.contextmanager
+    def context(self, name):
+        """Attribute database time on this thread to `name` (e.g. a maintenance job)."""
+        previous = getattr(self._local, "context", None)
+        self._local.context = name
+        try:
+            yield
+        finally:
+            self._local.context = previous
+
+    def record_db(self, seconds, statements=1):
+        """Add database time; rows fetched after execute are added with statements=0."""
+        local = self._local
+        local.db_time = getattr(local, "db_time", 0.0) + seconds
+        labels = self.context_labels()
+        if statements:
+            self.inc("keyhub_db_statements_total", labels, statements)
+        self.inc("keyhub_db_seconds_total", labels, seconds)
+
+    def record_lock_wait(self, seconds):
+        self.observe("keyhub_db_lock_wait_seconds", self.context_labels(), seconds)
+
+    def start_request(self, route):
+        local = self._local
+        local.context = route
+        local.db_time = 0.0
+        local.request_started = time.perf_counter()
+        self.inc("keyhub_http_requests_in_flight", (("route", route),))
+
+    def finish_request(self, method, status):
+        local = self._local
+        started = getattr(local, "request_started", None)
+        if started is None:
+            return
+        route = local.context
+        labels = (("route", route),)
+        self.inc("keyhub_http_requests_in_flight", labels, -1)
+        self.inc(
+            "keyhub_http_requests_total",
+            (("route", route), ("method", method), ("status", str(status))),
+        )
+        self.observe("keyhub_http_request_duration_seconds", labels, time.perf_counter() - started)
+        self.observe("keyhub_http_request_db_seconds", labels, local.db_time)
+        local.request_started = None
+        local.context = None
+
+    # --- Collection ---
+
+    def add_collector(self, prefix, stats, counters=(), exclude=()):
+        """Publish the numeric values of a stats() dict on every scrape.
+
+        Keys listed in `counters` become <prefix>_<key>_total, the rest gauges.
+        """
+        self._collectors.append((prefix, stats, frozenset(counters), frozenset(exclude)))
+
+    def snapshot(self):
+        """(counters, histograms) of this process, including collector values."""
+        counters, histograms = {}, {}
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # The thread is gone, so nothing writes to its shard any more.
+                    merge_into(
+                        self._retired.counters,
+                        self._retired.histograms,
+                        shard.counters.items(),
+                        shard.histograms.items(),
+                    )
+            self._shards = live
+            shards = [self._retired] + [shard for _thread, shard in live]
+            for shard in shards:
+                # Copies are taken first: owner threads may add keys meanwhile.
+                merge_into(
+                    counters,
+                    histograms,
+                    list(shard.counters.items()),
+                    list(shard.histograms.items()),
+                )
+
+        for prefix, stats, counter_keys, exclude in self._collectors:
+            for key, value in stats().items():
+                if key in exclude or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}_total" if key in counter_keys else f"{prefix}_{key}"
+                counters[(name, ())] = counters.get((name, ()), 0) + value
+        return counters, histograms
+
+    def export(self):
+        """Write this process's snapshot to the metrics directory for the other workers."""
+        if not self.directory:
+            return
+        counters, histograms = self.snapshot()
+        data = {
+            "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+            "histograms": [[name, labels, entry] for (name, labels), entry in histograms.items()],
+        }
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """Snapshot of this process plus the exported snapshots of the other workers."""
+        counters, histograms = self.snapshot()
+        if not self.directory:
+            return counters, histograms
+        own = f"{os.getpid()}.json"
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name == own or not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            merge_into(
+                counters,
+                histograms,
+                [((n, tuple(map(tuple, labels))), value) for n, labels, value in data["counters"]],
+                [((n, tuple(map(tuple, labels))), entry) for n, labels, entry in data["histograms"]],
+            )
+        return counters, histograms
+
+    def render(self, counters, histograms):
+        """Prometheus text exposition format."""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                kind = "counter" if name.endswith("_total") else "gauge"
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        bounds = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+        for (name, labels), entry in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(bounds, entry[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(entry[-1])}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
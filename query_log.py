@@ -0,0 +1,168 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Statements slower than this are logged with their query plan (0 logs none).
+SLOW_QUERY_MS = float(os.environ.get("KEYHUB_SLOW_QUERY_MS", "100"))
+# The same statement is logged at most once per interval; its counters still add up.
+SLOW_QUERY_LOG_INTERVAL = float(os.environ.get("KEYHUB_SLOW_QUERY_LOG_INTERVAL", "60"))
+# Distinct normalized statements tracked; the rest are counted under OTHER_STATEMENT.
+QUERY_STATS_MAX = int(os.environ.get("KEYHUB_QUERY_STATS_MAX", "2000"))
+
+OTHER_STATEMENT = "<other>"
+PLANNED_STATEMENTS = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"IN \(\?(?:, ?\?)+\)", re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """Collapse whitespace, literals and IN (?, ?, ...) lists into one statement shape."""
+    sql = _WHITESPACE.sub(" ", sql).strip()
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    return _IN_LIST.sub("IN (?...)", sql)
+
+
+def is_full_scan(plan):
+    """True if a plan step scans a table without an index."""
+    for detail in plan:
+        if detail.startswith("SCAN ") and "USING" not in detail and "CONSTANT ROW" not in detail:
+            if not detail.startswith("SCAN (subquery"):
+                return True
+    return False
+
+
+class QueryLog:
+    """Per-statement timing aggregated by normalized SQL, with a slow-query log.
+
+    A statement's duration runs from execute until its last row is fetched.
+    The first slow execution of a statement captures its EXPLAIN QUERY PLAN on
+    the same connection and with the same parameters. Counters cover this
+    process only.
+    """
+
+    def __init__(self, slow_ms=SLOW_QUERY_MS, max_statements=QUERY_STATS_MAX):
+        self.slow_seconds = slow_ms / 1000
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._normalized = {}
+        self._stats = {}
+        self._since = time.time()
+
+    def _normalize(self, sql):
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            if len(self._normalized) >= 4 * self.max_statements:
+                self._normalized.clear()
+            normalized = self._normalized[sql] = normalize_sql(sql)
+        return normalized
+
+    def record(self, conn, sql, parameters, elapsed, previous=None):
+        """Add an execution that took `elapsed` seconds.
+
+        With `previous`, the execution was already recorded with that duration
+        and has since run to `elapsed` (rows fetched from its cursor), so only
+        the difference is added and it is not counted as another call.
+        """
+        statement = self._normalize(sql)
+        # Slow once, when the running duration first reaches the threshold.
+        slow = self.slow_seconds > 0 and elapsed >= self.slow_seconds and (
+            previous is None or previous < self.slow_seconds
+        )
+        with self._lock:
+            entry = self._stats.get(statement)
+            if entry is None and previous is not None:
+                if len(self._stats) < self.max_statements:
+                    return  # reset since the execution was recorded
+                statement = OTHER_STATEMENT
+                entry = self._stats.get(statement)
+                if entry is None:
+                    return
+            if entry is None:
+                if len(self._stats) >= self.max_statements:
+                    statement = OTHER_STATEMENT
+                    entry = self._stats.get(statement)
+                if entry is None:
+                    entry = self._stats[statement] = {
+                        "calls": 0,
+                        "total_seconds": 0.0,
+                        "max_seconds": 0.0,
+                        "slow_calls": 0,
+                        "plan": None,
+                        "last_logged": None,
+                    }
+            if previous is None:
+                entry["calls"] += 1
+                entry["total_seconds"] += elapsed
+            else:
+                entry["total_seconds"] += elapsed - previous
+            if elapsed > entry["max_seconds"]:
+                entry["max_seconds"] = elapsed
+            if not slow:
+                return
+            entry["slow_calls"] += 1
+            capture_plan = entry["plan"] is None and statement != OTHER_STATEMENT
+            now = time.monotonic()
+            log = entry["last_logged"] is None or now - entry["last_logged"] >= SLOW_QUERY_LOG_INTERVAL
+            if log:
+                entry["last_logged"] = now
+
+        if capture_plan:
+            plan = self.explain(conn, sql, parameters)
+            with self._lock:
+                entry["plan"] = plan
+        if log:
+            print(f"慢查询 {elapsed * 1000:.1f} ms: {statement}")
+            for detail in entry["plan"] or ():
+                print(f"    {detail}")
+
+    def explain(self, conn, sql, parameters):
+        if parameters is None or not sql.lstrip().upper().startswith(PLANNED_STATEMENTS):
+            return []
+        try:
+            # Bypass the instrumented execute so the plan query is not recorded.
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters)
+            return [row[3] for row in rows.fetchall()]
+        except (sqlite3.Error, ValueError) as exc:
+            return [f"无法获取查询计划: {exc}"]
+
+    def top(self, limit=20, order_by="total_seconds"):
+        with self._lock:
+            items = [(statement, dict(entry)) for statement, entry in self._stats.items()]
+        items.sort(key=lambda item: item[1][order_by], reverse=True)
+        result = []
+        for statement, entry in items[:limit]:
+            result.append(
+                {
+                    "statement": statement,
+                    "calls": entry["calls"],
+                    "total_ms": round(entry["total_seconds"] * 1000, 3),
+                    "avg_ms": round(entry["total_seconds"] * 1000 / entry["calls"], 3),
+                    "max_ms": round(entry["max_seconds"] * 1000, 3),
+                    "slow_calls": entry["slow_calls"],
+                    "plan": entry["plan"],
+                    "full_scan": is_full_scan(entry["plan"]) if entry["plan"] else None,
+                }
+            )
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._since = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "statements": len(self._stats),
+                "since": self._since,
+                "slow_ms": self.slow_seconds * 1000,
+            }
+
+
+query_log = QueryLog()
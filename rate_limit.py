@@ -0,0 +1,207 @@
+import collections
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from database import DB_DIR
+from metrics import metrics
+
+RATE_LIMIT_ENABLED = os.environ.get("KEYHUB_RATE_LIMIT", "1") != "0"
+# "memory" keeps buckets per process; "sqlite" shares them between worker
+# processes through a small database of their own, never the main one.
+RATE_LIMIT_STORE = os.environ.get("KEYHUB_RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_DB_PATH = os.path.abspath(
+    os.environ.get("KEYHUB_RATE_LIMIT_DB_PATH", os.path.join(DB_DIR, "keyhub_ratelimit.db"))
+)
+# Buckets idle this long are full again and can be dropped.
+RATE_LIMIT_IDLE_SECONDS = 3600
+
+# route -> {scope: (tokens per second, burst)}. "ip" buckets are per client IP
+# (venues put many headsets behind one address, so they are generous); "key"
+# buckets are per (project, key) and stop a single client stuck in a loop.
+DEFAULT_RATE_LIMITS = {
+    "/api/verify": {"ip": (50, 200), "key": (2, 20)},
+    "/api/verify/batch": {"ip": (5, 20)},
+    "/api/license/status": {"ip": (50, 200), "key": (2, 20)},
+    "/api/play/start": {"ip": (10, 50), "key": (0.2, 5)},
+    "/api/register": {"ip": (1, 10), "key": (0.1, 3)},
+}
+
+
+def load_rate_limits(raw=None):
+    """Defaults overridden by KEYHUB_RATE_LIMITS, e.g.
+    {"/api/play/start": {"ip": [20, 100]}, "/api/verify": {"key": null}}
+    where null removes a scope.
+    """
+    limits = {route: dict(scopes) for route, scopes in DEFAULT_RATE_LIMITS.items()}
+    raw = raw if raw is not None else os.environ.get("KEYHUB_RATE_LIMITS")
+    if not raw:
+        return limits
+    for route, scopes in json.loads(raw).items():
+        target = limits.setdefault(route, {})
+        for scope, limit in scopes.items():
+            if limit is None:
+                target.pop(scope, None)
+            else:
+                rate, burst = limit
+                target[scope] = (float(rate), float(burst))
+    return limits
+
+
+RATE_LIMITS = load_rate_limits()
+
+
+class MemoryBucketStore:
+    """Token buckets of this process only, least recently used first."""
+
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+
+    def take(self, key, rate, burst, now):
+        """Take one token; returns (allowed, tokens left)."""
+        with self._lock:
+            buckets = self._buckets
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                buckets.move_to_end(key)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            buckets[key] = (tokens, now)
+            self._prune(now)
+            return allowed, tokens
+
+    def _prune(self, now):
+        # Only the oldest end is looked at, so each take costs O(1) amortized:
+        # idle buckets are dropped, then the least recently used beyond the cap.
+        buckets = self._buckets
+        cutoff = now - RATE_LIMIT_IDLE_SECONDS
+        while buckets:
+            _key, (_tokens, updated_at) = next(iter(buckets.items()))
+            if updated_at >= cutoff and len(buckets) <= self.max_buckets:
+                break
+            buckets.popitem(last=False)
+
+
+class SQLiteBucketStore:
+    """Token buckets shared by all processes on the host.
+
+    Each take is one UPSERT ... RETURNING in its own autocommit transaction on a
+    separate database file, so it never touches the main database's writer.
+    """
+
+    def __init__(self, path=RATE_LIMIT_DB_PATH, prune_interval=60):
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._last_prune = 0.0
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    allowed INTEGER NOT NULL
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_updated ON buckets(updated_at)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+        # Losing bucket state on a crash only refills the buckets.
+        conn.execute("PRAGMA synchronous = OFF")
+        return conn
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.conn = self._connect()
+            local.pid = os.getpid()
+        return local.conn
+
+    def take(self, key, rate, burst, now):
+        conn = self._conn()
+        # refill = tokens after refilling for the elapsed time, capped at burst
+        refill = "MIN(:burst, tokens + (:now - updated_at) * :rate)"
+        allowed, tokens = conn.execute(
+            f"""
+            INSERT INTO buckets (key, tokens, updated_at, allowed)
+            VALUES (:key, :burst - 1, :now, 1)
+            ON CONFLICT(key) DO UPDATE SET
+                tokens = CASE WHEN {refill} >= 1 THEN {refill} - 1 ELSE {refill} END,
+                updated_at = :now,
+                allowed = {refill} >= 1
+            RETURNING allowed, tokens
+            """,
+            {"key": key, "rate": rate, "burst": burst, "now": now},
+        ).fetchone()
+        if now - self._last_prune > self.prune_interval:
+            self._last_prune = now
+            conn.execute(
+                "DELETE FROM buckets WHERE updated_at < ?", (now - RATE_LIMIT_IDLE_SECONDS,)
+            )
+        return bool(allowed), tokens
+
+
+class RateLimiter:
+    def __init__(self, limits=RATE_LIMITS, store=None, enabled=RATE_LIMIT_ENABLED):
+        self.limits = limits
+        self.enabled = enabled
+        self._store = store
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        # Created on first use, so the sqlite store is opened in the worker.
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = (
+                        SQLiteBucketStore() if RATE_LIMIT_STORE == "sqlite" else MemoryBucketStore()
+                    )
+        return self._store
+
+    def check(self, route, ip=None, project=None, key=None):
+        """Take a token from each bucket the request falls into.
+
+        Returns None when allowed, otherwise the Retry-After seconds. Store
+        errors let the request through.
+        """
+        scopes = self.limits.get(route)
+        if not self.enabled or not scopes:
+            return None
+        identities = {"ip": ip, "key": f"{project}\x1f{key}" if key else None}
+        now = time.time()
+        retry_after = None
+        for scope, (rate, burst) in scopes.items():
+            identity = identities.get(scope)
+            if identity is None:
+                continue
+            try:
+                allowed, tokens = self.store.take(f"{route}\x1f{scope}\x1f{identity}", rate, burst, now)
+            except sqlite3.Error as exc:
+                metrics.inc("keyhub_rate_limit_errors_total", (("route", route),))
+                print(f"限流存储出错，已放行请求: {exc}")
+                continue
+            if not allowed:
+                metrics.inc("keyhub_rate_limit_rejected_total", (("route", route), ("scope", scope)))
+                wait = max(1, math.ceil((1 - tokens) / rate)) if rate > 0 else RATE_LIMIT_IDLE_SECONDS
+                retry_after = max(retry_after or 0, wait)
+        return retry_after
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,361 @@
+"""Pre-forking production launcher.
+
+The master migrates the database once, opens the listening socket and forks
+worker processes; it never imports app.py itself and runs no threads, so every
+worker starts from a clean, fork-safe state and imports the current app code.
+Each worker serves the WSGI app with a fixed pool of threads. Worker slot 0
+also runs the background maintenance jobs.
+
+Signals to the master:
+    SIGTERM / SIGINT  graceful shutdown: workers stop accepting, finish in-flight
+                      requests (e.g. play/start transactions), flush buffered
+                      heartbeats and exit
+    SIGHUP            graceful reload: a new generation of workers is started,
+                      then the old one is drained
+                      (database.py / maintenance.py changes need a full restart)
+
+Workers report health (requests, in-flight, pool and heartbeat counters) to the
+master over a pipe; the master writes the latest reports to KEYHUB_STATUS_PATH
+and replaces workers that die or stop reporting. Workers also export their
+metric snapshots to KEYHUB_METRICS_DIR so /metrics on any worker sums them.
+
+    python serve.py --bind 0.0.0.0:5001 --workers 4 --threads 16
+"""
+import argparse
+import concurrent.futures
+import errno
+import importlib
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import database
+from metrics import metrics
+
+SERVE_BIND = os.environ.get("KEYHUB_BIND", "0.0.0.0:5001")
+SERVE_WORKERS = int(os.environ.get("KEYHUB_WORKERS", str(os.cpu_count() or 1)))
+SERVE_THREADS = int(os.environ.get("KEYHUB_THREADS", str(database.DB_POOL_SIZE)))
+GRACEFUL_TIMEOUT = float(os.environ.get("KEYHUB_GRACEFUL_TIMEOUT", "30"))
+HEALTH_INTERVAL = float(os.environ.get("KEYHUB_HEALTH_INTERVAL", "5"))
+# A worker that has not reported for this long is considered hung and replaced.
+WORKER_TIMEOUT = float(os.environ.get("KEYHUB_WORKER_TIMEOUT", "60"))
+STATUS_PATH = os.environ.get(
+    "KEYHUB_STATUS_PATH", os.path.join(database.DB_DIR, "workers.json")
+)
+# Workers export metric snapshots here so /metrics on any worker covers all of them.
+METRICS_DIR = metrics.directory or os.path.join(database.DB_DIR, "metrics")
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """wsgiref server that handles connections on a fixed-size thread pool."""
+
+    def __init__(self, listener, app, threads):
+        super().__init__(
+            listener.getsockname()[:2], QuietRequestHandler, bind_and_activate=False
+        )
+        self.socket.close()
+        self.socket = listener
+        self.server_name, self.server_port = listener.getsockname()[:2]
+        self.setup_environ()
+        self.set_app(app)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="keyhub-worker"
+        )
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.in_flight += 1
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._lock:
+                self.in_flight -= 1
+                self.requests += 1
+
+    def server_close(self):
+        # The listening socket belongs to the master; only stop using it here.
+        pass
+
+
+def parse_bind(value):
+    host, _, port = value.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+def run_worker(slot, listener, health_fd, threads):
+    """Body of a forked worker process; never returns."""
+    os.environ["KEYHUB_SKIP_INIT_DB"] = "1"
+    os.environ["KEYHUB_MAINTENANCE"] = "1" if slot == 0 else "0"
+    # Workers share rate limit buckets unless configured otherwise.
+    os.environ.setdefault("KEYHUB_RATE_LIMIT_STORE", "sqlite")
+    for sig in (signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_IGN)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    status = 0
+    try:
+        app_module = importlib.import_module("app")
+        server = PooledWSGIServer(listener, app_module.app, threads)
+        serving = threading.Thread(
+            target=server.serve_forever, name="keyhub-accept", daemon=True
+        )
+        serving.start()
+
+        while not stopping.is_set():
+            report = {
+                "pid": os.getpid(),
+                "slot": slot,
+                "time": time.time(),
+                "requests": server.requests,
+                "in_flight": server.in_flight,
+                "pool": database.db_pool.stats(),
+                "heartbeats": app_module.heartbeat_buffer.stats(),
+            }
+            os.write(health_fd, (json.dumps(report) + "\n").encode())
+            try:
+                metrics.export()
+            except OSError as exc:
+                print(f"写入指标快照失败: {exc}")
+            stopping.wait(HEALTH_INTERVAL)
+
+        # Drain: stop accepting, let queued and running requests finish, then
+        # write buffered heartbeats before the pool is closed.
+        server.shutdown()
+        server.executor.shutdown(wait=True)
+        app_module.maintenance.stop(timeout=5)
+        app_module.heartbeat_buffer.stop(timeout=5)
+        database.db_pool.close_all()
+    except Exception as exc:
+        print(f"工作进程 {os.getpid()} 异常退出: {exc}")
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+class Worker:
+    def __init__(self, pid, slot, generation, health_fd):
+        self.pid = pid
+        self.slot = slot
+        self.generation = generation
+        self.health_fd = health_fd
+        self.buffer = b""
+        self.started_at = time.monotonic()
+        self.last_report_at = self.started_at
+        self.report = None
+        self.stopping_since = None
+
+
+class Master:
+    def __init__(self, bind, workers, threads):
+        self.bind = bind
+        self.worker_count = max(1, workers)
+        self.threads = max(1, threads)
+        self.listener = None
+        self.workers = {}
+        self.generation = 0
+        self.selector = selectors.DefaultSelector()
+        self.shutdown_requested = False
+        self.reload_requested = False
+
+    def run(self):
+        # Migrations run exactly once, before any worker exists.
+        database.init_db()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        for name in os.listdir(METRICS_DIR):
+            self.remove_metrics_snapshot(name)
+        metrics.directory = METRICS_DIR
+        self.listener = socket.create_server(self.bind, backlog=2048)
+        signal.signal(signal.SIGTERM, self._request_shutdown)
+        signal.signal(signal.SIGINT, self._request_shutdown)
+        signal.signal(signal.SIGHUP, self._request_reload)
+
+        print(
+            f"KeyHub 已启动: http://{self.bind[0]}:{self.bind[1]} "
+            f"({self.worker_count} 个进程 x {self.threads} 个线程)"
+        )
+        self.spawn_generation()
+        while True:
+            if self.shutdown_requested:
+                self.stop_workers(list(self.workers.values()))
+                if not self.workers:
+                    break
+            elif self.reload_requested:
+                self.reload_requested = False
+                old = [w for w in self.workers.values() if w.generation == self.generation]
+                self.spawn_generation()
+                self.stop_workers(old)
+                print("工作进程已重新加载")
+
+            self.read_reports(timeout=1.0)
+            self.reap_workers()
+            self.enforce_deadlines()
+            if not self.shutdown_requested:
+                self.replace_missing()
+            self.write_status()
+
+        self.listener.close()
+        print("KeyHub 已停止")
+
+    def _request_shutdown(self, signum, frame):
+        self.shutdown_requested = True
+
+    def _request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def spawn_generation(self):
+        self.generation += 1
+        for slot in range(self.worker_count):
+            self.spawn(slot)
+
+    def spawn(self, slot):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for worker in self.workers.values():
+                os.close(worker.health_fd)
+            run_worker(slot, self.listener, write_fd, self.threads)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        worker = Worker(pid, slot, self.generation, read_fd)
+        self.workers[pid] = worker
+        self.selector.register(read_fd, selectors.EVENT_READ, worker)
+
+    def stop_workers(self, workers):
+        for worker in workers:
+            if worker.stopping_since is None:
+                worker.stopping_since = time.monotonic()
+                self.signal_worker(worker, signal.SIGTERM)
+
+    def signal_worker(self, worker, sig):
+        try:
+            os.kill(worker.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def read_reports(self, timeout):
+        try:
+            events = self.selector.select(timeout)
+        except InterruptedError:
+            return
+        for key, _mask in events:
+            worker = key.data
+            try:
+                data = os.read(worker.health_fd, 65536)
+            except OSError as exc:
+                if exc.errno == errno.EAGAIN:
+                    continue
+                data = b""
+            if not data:
+                self.selector.unregister(worker.health_fd)
+                continue
+            worker.buffer += data
+            *lines, worker.buffer = worker.buffer.split(b"\n")
+            if lines:
+                worker.report = json.loads(lines[-1])
+                worker.last_report_at = time.monotonic()
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.health_fd in self.selector.get_map():
+                self.selector.unregister(worker.health_fd)
+            os.close(worker.health_fd)
+            # Counters of an exited worker drop out of the sum (seen as a reset).
+            self.remove_metrics_snapshot(f"{pid}.json")
+            if worker.stopping_since is None:
+                print(f"工作进程 {pid} 意外退出 (状态 {status})，正在重启")
+
+    def remove_metrics_snapshot(self, name):
+        try:
+            os.remove(os.path.join(METRICS_DIR, name))
+        except FileNotFoundError:
+            pass
+
+    def enforce_deadlines(self):
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if worker.stopping_since is not None:
+                if now - worker.stopping_since > GRACEFUL_TIMEOUT:
+                    print(f"工作进程 {worker.pid} 未能在限定时间内退出，强制结束")
+                    self.signal_worker(worker, signal.SIGKILL)
+            elif now - worker.last_report_at > WORKER_TIMEOUT:
+                print(f"工作进程 {worker.pid} 无响应，正在替换")
+                self.stop_workers([worker])
+
+    def replace_missing(self):
+        running = {
+            w.slot
+            for w in self.workers.values()
+            if w.generation == self.generation and w.stopping_since is None
+        }
+        for slot in range(self.worker_count):
+            if slot not in running:
+                self.spawn(slot)
+
+    def write_status(self):
+        status = {
+            "master_pid": os.getpid(),
+            "generation": self.generation,
+            "workers": [
+                {
+                    "pid": w.pid,
+                    "slot": w.slot,
+                    "generation": w.generation,
+                    "stopping": w.stopping_since is not None,
+                    "seconds_since_report": round(time.monotonic() - w.last_report_at, 1),
+                    "report": w.report,
+                }
+                for w in self.workers.values()
+            ],
+        }
+        tmp_path = STATUS_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, STATUS_PATH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KeyHub 生产环境启动器")
+    parser.add_argument("--bind", default=SERVE_BIND, help="host:port")
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS)
+    parser.add_argument("--threads", type=int, default=SERVE_THREADS)
+    args = parser.parse_args()
+    if not hasattr(os, "fork"):
+        raise SystemExit("serve.py 需要支持 fork 的系统（Linux/macOS），Windows 请使用 app.py")
+    Master(parse_bind(args.bind), args.workers, args.threads).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ const statsActive = document.getElementById('statsActive');
 const statsBound = document.getElementById('statsBound');
 
 const refreshBtn = document.getElementById('refreshBtn');
+const keySearchInput = document.getElementById('keySearchInput');
+const loadMoreBtn = document.getElementById('loadMoreBtn');
 const generateKeyBtn = document.getElementById('generateKeyBtn');
 const keysTableBody = document.querySelector('#keysTable tbody');
 const emptyState = document.getElementById('emptyState');
@@ -41,6 +43,10 @@ const validUntilGroup = document.getElementById('validUntilGroup');
 // State
 let currentProject = null;
 let projects = [];
+let keysCursor = null;
+let searchTimer = null;
+
+const KEYS_PAGE_SIZE = 100;
 
 const projectTypeLabels = {
     account: '账号管理',
@@ -126,6 +132,11 @@ function setupEventListeners() {
 
     // Toolbar
     refreshBtn.addEventListener('click', loadKeys);
+    loadMoreBtn.addEventListener('click', loadMoreKeys);
+    keySearchInput.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(loadKeys, 300);
+    });
     generateKeyBtn.addEventListener('click', () => {
         if (!currentProject) return showToast('请先选择一个项目');
         openKeyModal();
@@ -253,29 +264,64 @@ async function deleteCurrentProject() {
 
 // --- Keys Logic ---
 
+function keysPageUrl(cursor = null) {
+    const params = new URLSearchParams({
+        project_id: currentProject.id,
+        limit: KEYS_PAGE_SIZE
+    });
+    const search = keySearchInput.value.trim();
+    if (search) params.set('q', search);
+    if (cursor) params.set('cursor', cursor);
+    return `/api/keys?${params}`;
+}
+
 async function loadKeys() {
     if (!currentProject) return;
 
     try {
         keysTableBody.innerHTML = '<tr><td colspan="8" style="text-align:center">Loading...</td></tr>';
 
-        const res = await apiRequest(`/api/keys?project_id=${currentProject.id}`);
-        const licenses = await res.json();
+        const res = await apiRequest(keysPageUrl());
+        const page = await res.json();
+
+        renderKeys(page.items);
+        updatePaging(page.next_cursor);
+        updateStats();
+    } catch (e) {
+        console.error(e);
+        showToast('加载授权列表失败');
+    }
+}
+
+async function loadMoreKeys() {
+    if (!currentProject || !keysCursor) return;
 
-        renderKeys(licenses);
-        updateStats(licenses);
+    try {
+        loadMoreBtn.disabled = true;
+        const res = await apiRequest(keysPageUrl(keysCursor));
+        const page = await res.json();
+
+        renderKeys(page.items, true);
+        updatePaging(page.next_cursor);
     } catch (e) {
         console.error(e);
         showToast('加载授权列表失败');
+    } finally {
+        loadMoreBtn.disabled = false;
     }
 }
 
-function renderKeys(licenses) {
-    keysTableBody.innerHTML = '';
+function updatePaging(nextCursor) {
+    keysCursor = nextCursor;
+    loadMoreBtn.style.display = nextCursor ? 'inline-block' : 'none';
+}
+
+function renderKeys(licenses, append = false) {
+    if (!append) keysTableBody.innerHTML = '';
     const isPlaybackProject = currentProject?.project_type === 'playback';
     const canEditRemarks = ['activation', 'playback'].includes(currentProject?.project_type);
 
-    if (licenses.length === 0) {
+    if (!append && licenses.length === 0) {
         emptyState.style.display = 'block';
         return;
     }
@@ -371,11 +417,13 @@ function createBtn(text, onClick, isDanger = false) {
     return btn;
 }
 
-function updateStats(licenses) {
-    statsTotal.textContent = licenses.length;
-    statsActive.textContent = licenses.filter(l => l.is_active).length;
+async function updateStats() {
+    const res = await apiRequest(`/api/projects/${currentProject.id}/stats`);
+    const stats = await res.json();
+    statsTotal.textContent = stats.total;
+    statsActive.textContent = stats.active;
     // Show disabled count instead
-    statsBound.textContent = licenses.filter(l => !l.is_active).length;
+    statsBound.textContent = stats.disabled;
 }
 
 async function handleKeySubmit(e) {